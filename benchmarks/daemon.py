@@ -0,0 +1,39 @@
+"""Runs the GATT application on the benchmark IOC axes.
+
+Started by ``benchmarks.harness`` on its private D-Bus; it takes a well-known bus name so
+the harness can reach the application objects the way BlueZ would.
+"""
+
+import argparse
+import sys
+
+import dbus
+import dbus.mainloop.glib
+import dbus.service
+
+from ble_motor_ctrl import application
+from ble_motor_ctrl.bletools import BleTools
+
+BUS_NAME = "org.cnpem.BleMotorBench"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--axes", type=int, default=8, help="number of axes")
+    parser.add_argument("--prefix", default="BENCH:", help="PV prefix")
+    parser.add_argument("--mode", choices=("monitor", "poll"), default="monitor", help="notify mode")
+    parser.add_argument("--group-size", type=int, default=application.GROUP_SIZE, help="axes per service")
+    parser.add_argument("--runtime", choices=("glib", "asyncio"), default="glib", help="daemon runtime")
+    args = parser.parse_args()
+    pvs = [f"{args.prefix}m{id}" for id in range(1, args.axes + 1)]
+
+    if args.runtime == "asyncio":
+        from ble_motor_ctrl import aio
+
+        aio.run(pvs, "Benchmark", group_size=args.group_size, bus_name=BUS_NAME)
+        sys.exit()
+
+    # The bus must be created with the GLib main loop in place to get signals and async replies
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    name = dbus.service.BusName(BUS_NAME, BleTools.get_bus())
+    application.register(pvs, "Benchmark", args.mode, group_size=args.group_size)
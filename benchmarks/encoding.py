@@ -0,0 +1,41 @@
+"""Encode cost and payload size of the characteristic value formats.
+
+Run from the repository root with ``python3 -m benchmarks.encoding``.
+"""
+
+import argparse
+import timeit
+
+import dbus
+
+from ble_motor_ctrl.encoding import ASCII, FLOAT64, INT32, encode_number
+
+# Positions within the int32 range at the default 5 decimals
+SAMPLES = [0.0, -1.5, 12.34567, 12345.67891, -9876.54321]
+
+
+def encode_legacy(value):
+    strtemp = str(round(value, 5))
+    return [dbus.Byte(c.encode()) for c in strtemp]
+
+
+def run(number):
+    encoders = {
+        "legacy": encode_legacy,
+        ASCII: lambda value: encode_number(value, ASCII),
+        FLOAT64: lambda value: encode_number(value, FLOAT64),
+        INT32: lambda value: encode_number(value, INT32),
+    }
+
+    print(f"{'format':<10}{'ns/encode':>12}{'bytes (min/max)':>18}")
+    for name, encode in encoders.items():
+        elapsed = timeit.timeit(lambda: [encode(value) for value in SAMPLES], number=number)
+        sizes = [len(encode(value)) for value in SAMPLES]
+        ns = elapsed / (number * len(SAMPLES)) * 1e9
+        print(f"{name:<10}{ns:>12.0f}{f'{min(sizes)}/{max(sizes)}':>18}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=20000, help="iterations per format")
+    run(parser.parse_args().number)
@@ -0,0 +1,257 @@
+"""End-to-end benchmark of the daemon against a mock BlueZ and a simulated motor IOC.
+
+Starts a private system bus with python-dbusmock standing in for BlueZ, the caproto IOC of
+``benchmarks.ioc`` and the daemon of ``benchmarks.daemon``, then acts as the central:
+reads every position characteristic, subscribes to all of them and moves the axes through
+GATT writes. Read latency, notify throughput, write to notification latency and daemon CPU
+are written as JSON. Run from the repository root with ``python3 -m benchmarks.harness``.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.mainloop.glib
+import dbusmock
+from caproto.sync.client import read as ca_read
+
+from ble_motor_ctrl.protocol import FIRST_AXIS_ID, POSITION_UUID_GROUP, make_uuid
+from benchmarks.daemon import BUS_NAME
+from benchmarks.ioc import PREFIX, PROFILES
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+BLUEZ_MOCK_IFACE = "org.bluez.Mock"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+STARTUP_TIMEOUT = 30
+CA_ENV = {"EPICS_CA_ADDR_LIST": "127.0.0.1", "EPICS_CA_AUTO_ADDR_LIST": "NO"}
+
+
+def get_percentiles(samples):
+    if not samples:
+        return {"count": 0}
+
+    samples = sorted(samples)
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 3)
+
+    return {"count": len(samples), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": at(1.0)}
+
+
+def get_cpu_time(pid):
+    # utime and stime of /proc/<pid>/stat, in seconds
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def wait_for(check, timeout=STARTUP_TIMEOUT, what="startup"):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"Timed out waiting for {what}")
+
+
+def start_bluez(bus):
+    # bluez5 only models adapters and devices, so the GATT and advertising managers are added here
+    server, mock = dbusmock.DBusTestCase.spawn_server_template("bluez5", {}, stdout=subprocess.DEVNULL)
+    adapter_path = mock.AddAdapter("hci0", "bench", dbus_interface=BLUEZ_MOCK_IFACE)
+    adapter = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter_path), dbusmock.MOCK_IFACE)
+    adapter.AddMethods(
+        GATT_MANAGER_IFACE,
+        [("RegisterApplication", "oa{sv}", "", ""), ("UnregisterApplication", "o", "", "")],
+    )
+    adapter.AddProperties(GATT_MANAGER_IFACE, dbus.Dictionary({}, signature="sv"))
+    adapter.AddMethods(
+        LE_ADVERTISING_MANAGER_IFACE,
+        [("RegisterAdvertisement", "oa{sv}", "", ""), ("UnregisterAdvertisement", "o", "", "")],
+    )
+    adapter.AddProperties(
+        LE_ADVERTISING_MANAGER_IFACE,
+        {"ActiveInstances": dbus.Byte(0), "SupportedInstances": dbus.Byte(5)},
+    )
+    return server
+
+
+def find_positions(bus, axes):
+    om = dbus.Interface(bus.get_object(BUS_NAME, "/"), DBUS_OM_IFACE)
+    paths = {}
+    for path, interfaces in om.GetManagedObjects().items():
+        chrc = interfaces.get(GATT_CHRC_IFACE)
+        if chrc is not None:
+            paths[str(chrc["UUID"])] = path
+
+    uuids = [make_uuid(id, POSITION_UUID_GROUP) for id in range(FIRST_AXIS_ID, FIRST_AXIS_ID + axes)]
+    return [dbus.Interface(bus.get_object(BUS_NAME, paths[uuid]), GATT_CHRC_IFACE) for uuid in uuids]
+
+
+def decode(value):
+    return float(bytes(value).decode())
+
+
+def encode(value):
+    return dbus.Array([dbus.Byte(c) for c in str(round(value, 5)).encode()], signature="y")
+
+
+def measure_reads(positions, reads):
+    latencies = []
+    for chrc in positions:
+        for _ in range(reads):
+            start = time.monotonic()
+            chrc.ReadValue({})
+            latencies.append(time.monotonic() - start)
+    return get_percentiles(latencies)
+
+
+class NotifyRun(object):
+    """Subscribes to every axis and, unless the IOC drives them, moves them back and forth."""
+
+    def __init__(self, bus, positions, duration, interval, amplitude, move):
+        self.bus = bus
+        self.positions = positions
+        self.duration = duration
+        self.interval = interval
+        self.amplitude = amplitude
+        self.move = move
+        self.received = {chrc.object_path: 0 for chrc in positions}
+        self.targets = {}
+        self.latencies = []
+        self.direction = 1
+        self.mainloop = GObject.MainLoop()
+
+    def run(self):
+        self.bus.add_signal_receiver(
+            self._on_properties_changed,
+            dbus_interface=DBUS_PROP_IFACE,
+            signal_name="PropertiesChanged",
+            bus_name=BUS_NAME,
+            path_keyword="path",
+        )
+        for chrc in self.positions:
+            chrc.StartNotify()
+
+        if self.move:
+            self._move()
+            GObject.timeout_add(int(self.interval * 1000), self._move)
+        GObject.timeout_add(int(self.duration * 1000), self.mainloop.quit)
+        self.mainloop.run()
+
+        for chrc in self.positions:
+            chrc.StopNotify()
+
+        total = sum(self.received.values())
+        return {
+            "total": total,
+            "per_second": round(total / self.duration, 1),
+            "per_axis_per_second": round(total / self.duration / len(self.positions), 1),
+        }
+
+    def _move(self):
+        target = self.direction * self.amplitude
+        self.direction = -self.direction
+        for chrc in self.positions:
+            self.targets[chrc.object_path] = (target, time.monotonic())
+            chrc.WriteValue(encode(target), {}, reply_handler=lambda: None, error_handler=print)
+        return True
+
+    def _on_properties_changed(self, interface, changed, invalidated, path=None):
+        if interface != GATT_CHRC_IFACE or "Value" not in changed or path not in self.received:
+            return
+
+        self.received[path] += 1
+        target = self.targets.get(path)
+        if target is not None and abs(decode(changed["Value"]) - target[0]) < 1e-4:
+            self.latencies.append(time.monotonic() - target[1])
+            del self.targets[path]
+
+
+def run(args):
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    dbusmock.DBusTestCase.start_system_bus()
+    processes = []
+    try:
+        bus = dbus.SystemBus()
+        processes.append(start_bluez(bus))
+
+        env = {**os.environ, **CA_ENV}
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.ioc", "--axes", str(args.axes), "--profile", args.profile]
+                + ["--rate", str(args.rate), "--amplitude", str(args.amplitude)],
+                env=env,
+                stdout=subprocess.DEVNULL,
+            )
+        )
+        os.environ.update(CA_ENV)
+        wait_for(lambda: ca_read(f"{PREFIX}m{args.axes}.RBV", timeout=1), what="the IOC")
+
+        daemon = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.daemon", "--axes", str(args.axes), "--mode", args.mode]
+            + ["--runtime", args.runtime],
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        processes.append(daemon)
+        wait_for(lambda: find_positions(bus, args.axes), what="the daemon")
+        positions = find_positions(bus, args.axes)
+
+        result = {
+            "commit": subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip(),
+            "config": vars(args),
+            "read_latency_ms": measure_reads(positions, args.reads),
+        }
+
+        cpu_start, start = get_cpu_time(daemon.pid), time.monotonic()
+        notify_run = NotifyRun(
+            bus, positions, args.duration, args.interval, args.amplitude, move=args.profile != "sine"
+        )
+        result["notify"] = notify_run.run()
+        cpu = (get_cpu_time(daemon.pid) - cpu_start) / (time.monotonic() - start) * 100
+        result["update_latency_ms"] = get_percentiles(notify_run.latencies)
+        result["cpu_percent"] = {"total": round(cpu, 2), "per_axis": round(cpu / args.axes, 3)}
+        return result
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        dbusmock.DBusTestCase.stop_dbus(dbusmock.DBusTestCase.system_bus_pid)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--axes", type=int, default=8, help="number of axes")
+    parser.add_argument("--profile", choices=PROFILES, default="step", help="IOC motion profile")
+    parser.add_argument("--rate", type=float, default=100.0, help="IOC position updates per second")
+    parser.add_argument("--amplitude", type=float, default=10.0, help="move and sine amplitude")
+    parser.add_argument("--mode", choices=("monitor", "poll"), default="monitor", help="notify mode")
+    parser.add_argument("--runtime", choices=("glib", "asyncio"), default="glib", help="daemon runtime")
+    parser.add_argument("--reads", type=int, default=200, help="reads per axis")
+    parser.add_argument("--duration", type=float, default=10.0, help="notify run length, seconds")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between moves")
+    parser.add_argument("-o", "--output", help="JSON output file, stdout by default")
+    args = parser.parse_args()
+
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(result + "\n")
+    else:
+        print(result)
@@ -0,0 +1,107 @@
+"""Simulated motor IOC for the benchmarks.
+
+Serves ``<prefix>m1`` to ``<prefix>m<axes>`` with the motor record fields the daemon uses.
+Run with ``python3 -m benchmarks.ioc``; clients find it with
+``EPICS_CA_ADDR_LIST=127.0.0.1 EPICS_CA_AUTO_ADDR_LIST=NO``.
+"""
+
+import argparse
+import math
+import time
+
+from caproto import ChannelType
+from caproto.server import PVGroup, SubGroup, pvproperty, run
+
+PREFIX = "BENCH:"
+PROFILES = ("step", "ramp", "sine")
+
+
+class Axis(PVGroup):
+    """
+    One motor. With the step profile .RBV jumps to every new target, with ramp it travels
+    there at velocity units/s, and with sine it oscillates around 0 regardless of .VAL.
+    """
+
+    profile = "step"
+    period = 0.01
+    velocity = 10.0
+    amplitude = 10.0
+    frequency = 1.0
+
+    val = pvproperty(name=".VAL", value=0.0, precision=5)
+    rbv = pvproperty(name=".RBV", value=0.0, precision=5, read_only=True)
+    rlv = pvproperty(name=".RLV", value=0.0, precision=5)
+    movn = pvproperty(name=".MOVN", value=0, read_only=True)
+    lvio = pvproperty(name=".LVIO", value=0, read_only=True)
+    stop = pvproperty(name=".STOP", value=0)
+    desc = pvproperty(name=".DESC", value="Benchmark axis", dtype=ChannelType.STRING)
+    egu = pvproperty(name=".EGU", value="mm", dtype=ChannelType.STRING)
+    hlm = pvproperty(name=".HLM", value=1000.0)
+    llm = pvproperty(name=".LLM", value=-1000.0)
+
+    @val.putter
+    async def val(self, instance, value):
+        self.target = value
+        return value
+
+    @rlv.putter
+    async def rlv(self, instance, value):
+        self.target = self.rbv.value + value
+        await self.val.write(self.target, verify_value=False)
+        return 0.0
+
+    @stop.putter
+    async def stop(self, instance, value):
+        if value:
+            self.target = self.rbv.value
+        return 0
+
+    @rbv.startup
+    async def rbv(self, instance, async_lib):
+        self.target = 0.0
+        start = time.monotonic()
+        while True:
+            await async_lib.library.sleep(self.period)
+            position = instance.value
+            if self.profile == "sine":
+                position = self.amplitude * math.sin(2 * math.pi * self.frequency * (time.monotonic() - start))
+            elif self.profile == "ramp":
+                step = self.velocity * self.period
+                position += max(-step, min(step, self.target - position))
+            else:
+                position = self.target
+
+            moving = int(position != instance.value)
+            if moving or self.movn.value:
+                await instance.write(position)
+            if moving != self.movn.value:
+                await self.movn.write(moving)
+
+
+def make_ioc(axes, prefix=PREFIX, **settings):
+    axis = type("BenchAxis", (Axis,), settings)
+    group = type("BenchIOC", (PVGroup,), {f"m{id}": SubGroup(axis, prefix=f"m{id}") for id in range(1, axes + 1)})
+    return group(prefix=prefix)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--axes", type=int, default=8, help="number of axes")
+    parser.add_argument("--prefix", default=PREFIX, help="PV prefix")
+    parser.add_argument("--profile", choices=PROFILES, default="step", help="motion profile")
+    parser.add_argument("--rate", type=float, default=100.0, help="position updates per second")
+    parser.add_argument("--velocity", type=float, default=10.0, help="ramp velocity, units/s")
+    parser.add_argument("--amplitude", type=float, default=10.0, help="sine amplitude")
+    parser.add_argument("--frequency", type=float, default=1.0, help="sine frequency, Hz")
+    args = parser.parse_args()
+
+    ioc = make_ioc(
+        args.axes,
+        args.prefix,
+        profile=args.profile,
+        period=1 / args.rate,
+        velocity=args.velocity,
+        amplitude=args.amplitude,
+        frequency=args.frequency,
+    )
+    run(ioc.pvdb, module_name="caproto.asyncio.server", interfaces=["127.0.0.1"], log_pv_names=False)
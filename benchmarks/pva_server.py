@@ -0,0 +1,74 @@
+"""Local pvAccess motor server for trying the pva backend.
+
+Serves ``<prefix>m1`` to ``<prefix>m<axes>`` fields as NTScalars, plus a ``<prefix>m<id>:state``
+group PV with the rbv, movn and lvio sub-structures the backend expects. Puts to .VAL move
+the axis at velocity units/s. Run with ``python3 -m benchmarks.pva_server``.
+"""
+
+import argparse
+import time
+
+from p4p.nt import NTScalar
+from p4p.server import Server
+from p4p.server.thread import SharedPV
+from p4p.wrapper import Type, Value
+
+PREFIX = "BENCH:"
+PERIOD = 0.01
+DOUBLE = NTScalar("d", display=True, control=True)
+SHORT = NTScalar("h")
+STATE = Type([("rbv", DOUBLE.type), ("movn", SHORT.type), ("lvio", SHORT.type)])
+
+
+class PVAAxis(object):
+    def __init__(self, velocity):
+        self.velocity = velocity
+        self.target = 0.0
+        self.position = 0.0
+        self.rbv = SharedPV(nt=DOUBLE, initial={"value": 0.0, "display.units": "mm", "display.precision": 5})
+        self.movn = SharedPV(nt=SHORT, initial=0)
+        self.lvio = SharedPV(nt=SHORT, initial=0)
+        self.state = SharedPV(initial=self.get_state(0.0, 0))
+        self.val = SharedPV(nt=DOUBLE, initial=0.0, handler=self)
+
+    @staticmethod
+    def get_state(position, moving):
+        return Value(STATE, {"rbv": {"value": position}, "movn": {"value": moving}, "lvio": {"value": 0}})
+
+    def put(self, pv, op):
+        self.target = float(op.value())
+        pv.post(self.target)
+        op.done()
+
+    def get_pvs(self, name):
+        pvs = {".VAL": self.val, ".RBV": self.rbv, ".MOVN": self.movn, ".LVIO": self.lvio, ":state": self.state}
+        return {name + suffix: pv for suffix, pv in pvs.items()}
+
+    def step(self, period):
+        step = self.velocity * period
+        position = self.position + max(-step, min(step, self.target - self.position))
+        moving = int(position != self.position)
+        if moving or self.movn.current():
+            self.position = position
+            self.rbv.post(position)
+            self.movn.post(moving)
+            self.state.post(self.get_state(position, moving))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--axes", type=int, default=2, help="number of axes")
+    parser.add_argument("--prefix", default=PREFIX, help="PV prefix")
+    parser.add_argument("--velocity", type=float, default=10.0, help="velocity, units/s")
+    args = parser.parse_args()
+
+    axes = [PVAAxis(args.velocity) for _ in range(args.axes)]
+    providers = {}
+    for id, axis in enumerate(axes, 1):
+        providers.update(axis.get_pvs(f"{args.prefix}m{id}"))
+
+    with Server(providers=[providers]):
+        while True:
+            time.sleep(PERIOD)
+            for axis in axes:
+                axis.step(PERIOD)
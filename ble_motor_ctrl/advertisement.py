@@ -109,20 +109,22 @@ class Advertisement(dbus.service.Object):
     def Release(self):
         print("%s: Released!" % self.path)
 
-    def register_ad_callback(self):
+    def register_ad_callback(self, callback=None):
         print("GATT advertisement registered")
+        if callback is not None:
+            callback()
 
     def register_ad_error_callback(self, err):
         print("Failed to register GATT advertisement: %s" % str(err))
 
-    def register(self):
+    def register(self, adapter=None, callback=None):
         bus = BleTools.get_bus()
-        adapter = BleTools.find_adapter(bus)
+        adapter = adapter or BleTools.find_adapter(bus)
 
         ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter), LE_ADVERTISING_MANAGER_IFACE)
         ad_manager.RegisterAdvertisement(
             self.get_path(),
             {},
-            reply_handler=self.register_ad_callback,
+            reply_handler=lambda: self.register_ad_callback(callback),
             error_handler=self.register_ad_error_callback,
         )
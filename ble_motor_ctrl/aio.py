@@ -0,0 +1,917 @@
+"""
+asyncio runtime. Serves the services, characteristics and UUIDs of application.py with
+dbus-next, and reads, writes and monitors PVs through aioca. Every GATT request runs as
+its own coroutine, so a slow IOC only delays the requests that wait on it.
+"""
+
+import asyncio
+import time
+from functools import partial
+
+from aioca import FORMAT_CTRL, caget, camonitor, caput, connect
+from dbus_next import BusType, DBusError, Message, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.service import PropertyAccess, ServiceInterface, dbus_property, method
+
+from ble_motor_ctrl.cache import FETCH_TIMEOUT
+from ble_motor_ctrl.encoding import (
+    ASCII,
+    DIGITS,
+    INVALID,
+    NO_PV,
+    check_digits,
+    check_format,
+    decode_move_frame,
+    decode_number,
+    decode_string,
+    encode_flag,
+    encode_move_done,
+    encode_move_result,
+    encode_presentation_format,
+    encode_string,
+)
+from ble_motor_ctrl.history import histories
+from ble_motor_ctrl.metadata import get_axes, get_pv_names, metadata
+from ble_motor_ctrl.metrics import (
+    CA_GET_SECONDS,
+    CA_PUT_SECONDS,
+    GATT_ERRORS,
+    MAINLOOP_LAG,
+    MOVE_SECONDS,
+    NOTIFICATIONS,
+    SERVICE_SECONDS,
+    registry,
+)
+from ble_motor_ctrl.policy import NotifyPolicy, PolicyGate
+from ble_motor_ctrl.protocol import (
+    AXES_UUID_GROUP,
+    DIAG_UUID_GROUP,
+    DISCARDED,
+    DONE,
+    FIRST_AXIS_ID,
+    GROUP_SIZE,
+    HISTORY_UUID_GROUP,
+    INDEX_UUID_GROUP,
+    MOTOR_SVC_UUID,
+    MOVE_DONE_FIELDS,
+    MOVE_DONE_UUID_GROUP,
+    MOVE_UUID_GROUP,
+    MOVN_UUID_GROUP,
+    POSITION_UUID_GROUP,
+    PUT_TIMEOUT,
+    RBPV_UUID_GROUP,
+    STOPPED,
+    AxesFrame,
+    AxisTable,
+    GroupMove,
+    HistoryWindows,
+    PVWatchList,
+    encode_diagnostics,
+    encode_lvio,
+    encode_notified_position,
+    encode_position,
+    fit_notification,
+    get_group_targets,
+    get_move_timeout,
+    make_uuid,
+    read_long,
+)
+from ble_motor_ctrl.protocol import FAILED as MOVE_FAILED
+from ble_motor_ctrl.sessions import DBUS_PROP_IFACE, DEVICE_IFACE, sessions
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+GATT_SERVICE_IFACE = "org.bluez.GattService1"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+GATT_DESC_IFACE = "org.bluez.GattDescriptor1"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+FAILED = "org.bluez.Error.Failed"
+NOT_SUPPORTED = "org.bluez.Error.NotSupported"
+VALIDATE_TIMEOUT = 0.5
+LAG_PROBE_PERIOD = 0.1
+
+
+def as_dbus_error(e):
+    # The shared helpers raise the exceptions of errors.py, which carry the BlueZ error name
+    if isinstance(e, DBusError):
+        return e
+    return DBusError(getattr(e, "_dbus_error_name", FAILED), str(e))
+
+
+async def read_blob(key, options, read):
+    """read_long for coroutines: await read() builds the value at offset 0, Read Blobs slice its snapshot."""
+    future = asyncio.get_event_loop().create_future()
+
+    def start(reply, error):
+        task = asyncio.ensure_future(read())
+        task.add_done_callback(lambda task: error(task.exception()) if task.exception() else reply(task.result()))
+
+    read_long(key, options, start, future.set_result, future.set_exception)
+    return await future
+
+
+class AioPVs(object):
+    """
+    Same interface as MonitorEngine, on aioca monitors delivered in the event loop. Reads
+    of monitored PVs are answered from the last update, the others with a caget.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.callbacks = {}
+        self.values = {}
+
+    def subscribe(self, pv_name, callback):
+        callbacks = self.callbacks.setdefault(pv_name, [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+
+        if pv_name not in self.subscriptions:
+            self.subscriptions[pv_name] = camonitor(pv_name, partial(self._on_change, pv_name), notify_disconnect=True)
+        elif self.values.get(pv_name) is not None:
+            callback(self.values[pv_name])
+
+    def unsubscribe(self, pv_name, callback):
+        callbacks = self.callbacks.get(pv_name, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+        if not callbacks and pv_name in self.subscriptions:
+            self.subscriptions.pop(pv_name).close()
+            self.callbacks.pop(pv_name, None)
+            self.values.pop(pv_name, None)
+
+    def set_period(self, pv_name, callback, period):
+        pass
+
+    def _on_change(self, pv_name, value):
+        value = value if value.ok else None
+        self.values[pv_name] = value
+        for callback in list(self.callbacks.get(pv_name, [])):
+            try:
+                callback(value)
+            except Exception as e:
+                print(f"{pv_name}: monitor callback failed: {e}")
+
+    async def get(self, pv_name, timeout=FETCH_TIMEOUT):
+        value = self.values.get(pv_name)
+        if value is not None:
+            return value
+
+        start = time.monotonic()
+        value = await caget(pv_name, timeout=timeout, throw=False)
+        CA_GET_SECONDS.observe(time.monotonic() - start, pv_name)
+        if not value.ok:
+            raise DBusError(FAILED, f"Timed out reading {pv_name}")
+        return value
+
+    async def get_units(self, pv_name, timeout=FETCH_TIMEOUT):
+        value = await caget(pv_name, format=FORMAT_CTRL, timeout=timeout, throw=False)
+        return value.units if value.ok else None
+
+    def get_stats(self):
+        return {"monitors": len(self.subscriptions)}
+
+
+class AioCommandQueue(object):
+    """
+    Same policy as CommandQueue: every move is put at once, retargeting a moving axis, and
+    its callback and the done listeners get DONE, FAILED, DISCARDED when a newer move
+    replaced it first, or STOPPED when a stop was written while it ran.
+    """
+
+    def __init__(self, pv_name, notifier):
+        self.pv_name = pv_name
+        self.notifier = notifier
+        # Moves whose put has not completed yet, by token, with their callbacks
+        self.moves = {}
+        self.stopped = set()
+        self.done_listeners = []
+        self.issued = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.overdue = 0
+
+    def add_done_listener(self, callback):
+        self.done_listeners.append(callback)
+
+    async def check(self, field):
+        try:
+            await connect(f"{self.pv_name}.{field}", timeout=VALIDATE_TIMEOUT)
+        except Exception:
+            raise DBusError(FAILED, f"{self.pv_name}.{field} is not connected")
+
+    def move(self, field, value, callback=None):
+        self._discard()
+        token = object()
+        self.moves[token] = callback
+        self.issued += 1
+        asyncio.ensure_future(self._run(token, field, value))
+
+    def stop(self, value):
+        self.stopped.update(self.moves)
+        asyncio.ensure_future(self._put(f"{self.pv_name}.STOP", value, wait=False))
+
+    def get_depth(self):
+        return len(self.moves)
+
+    def get_stats(self):
+        return {
+            "depth": self.get_depth(),
+            "issued": self.issued,
+            "coalesced": self.coalesced,
+            "completed": self.completed,
+            "failed": self.failed,
+            "overdue": self.overdue,
+        }
+
+    def _discard(self):
+        for token in list(self.moves):
+            self.coalesced += 1
+            self._finish(token, DISCARDED)
+
+    def _finish(self, token, outcome):
+        callback = self.moves.pop(token)
+        self.stopped.discard(token)
+        if callback is not None:
+            callback(outcome)
+        if outcome != DISCARDED:
+            for listener in self.done_listeners:
+                listener(outcome)
+
+    async def _run(self, token, field, value):
+        start = time.monotonic()
+        position = self.notifier.values.get(f"{self.pv_name}.RBV")
+        timeout = get_move_timeout(self.pv_name, field, value, position)
+        timer = asyncio.get_event_loop().call_later(timeout, self._on_timeout, token, timeout)
+        try:
+            done = await self._put(f"{self.pv_name}.{field}", value, wait=True)
+        finally:
+            timer.cancel()
+        if token not in self.moves:
+            return
+
+        if not done:
+            self._finish(token, MOVE_FAILED)
+        elif token in self.stopped:
+            self.completed += 1
+            self._finish(token, STOPPED)
+        else:
+            self.completed += 1
+            MOVE_SECONDS.observe(time.monotonic() - start, self.pv_name)
+            self._finish(token, DONE)
+
+    def _on_timeout(self, token, timeout):
+        if token in self.moves:
+            self.overdue += 1
+            print(f"{self.pv_name}: move still running after {timeout:.1f} s")
+
+    async def _put(self, pv_name, value, wait):
+        start = time.monotonic()
+        try:
+            # A completion only comes once the move is done, however long it takes
+            await caput(pv_name, value, wait=wait, timeout=None if wait else PUT_TIMEOUT)
+        except Exception as e:
+            self.failed += 1
+            print(f"{pv_name}: put failed: {e}")
+            return False
+
+        if wait:
+            CA_PUT_SECONDS.observe(time.monotonic() - start, pv_name)
+        return True
+
+
+class AioPolicyGate(PolicyGate):
+    def start_timer(self, delay, callback):
+        return asyncio.get_event_loop().call_later(delay, callback)
+
+    def cancel_timer(self, timer):
+        timer.cancel()
+
+
+class AioGattObject(ServiceInterface):
+    """ReadValue and WriteValue of characteristics and descriptors, answered by read and write."""
+
+    def __init__(self, interface, path, uuid, flags):
+        ServiceInterface.__init__(self, interface)
+        self.interface = interface
+        self.path = path
+        self.uuid = uuid
+        self.flags = flags
+
+    async def read(self, options):
+        raise DBusError(NOT_SUPPORTED, "Read not supported")
+
+    async def write(self, value, options):
+        raise DBusError(NOT_SUPPORTED, "Write not supported")
+
+    async def handle(self, name, handler, *args):
+        labels = (type(self).__name__, name)
+        start = time.monotonic()
+        try:
+            return await handler(*args)
+        except Exception as e:
+            GATT_ERRORS.inc(*labels)
+            raise as_dbus_error(e)
+        finally:
+            SERVICE_SECONDS.observe(time.monotonic() - start, *labels)
+
+    @method()
+    async def ReadValue(self, options: "a{sv}") -> "ay":
+        options = {key: variant.value for key, variant in options.items()}
+        return bytes(await self.handle("ReadValue", self.read, options))
+
+    @method()
+    async def WriteValue(self, value: "ay", options: "a{sv}"):
+        options = {key: variant.value for key, variant in options.items()}
+        await self.handle("WriteValue", self.write, value, options)
+
+
+class AioDescriptor(AioGattObject):
+    def __init__(self, characteristic, uuid, flags, read=None, write=None):
+        path = f"{characteristic.path}/desc{len(characteristic.descriptors)}"
+        AioGattObject.__init__(self, GATT_DESC_IFACE, path, uuid, flags)
+        self.characteristic = characteristic
+        if read is not None:
+            self.read = read
+        if write is not None:
+            self.write = write
+
+    def get_properties(self):
+        return {
+            GATT_DESC_IFACE: {
+                "Characteristic": Variant("o", self.characteristic.path),
+                "UUID": Variant("s", self.uuid),
+                "Flags": Variant("as", self.flags),
+            }
+        }
+
+
+class AioCharacteristic(AioGattObject):
+    def __init__(self, service, uuid, flags):
+        path = f"{service.path}/char{len(service.characteristics)}"
+        AioGattObject.__init__(self, GATT_CHRC_IFACE, path, uuid, flags)
+        self.service = service
+        self.descriptors = []
+        self.notifying = False
+        self.value = b""
+
+    def add_descriptor(self, uuid, flags, read=None, write=None):
+        self.descriptors.append(AioDescriptor(self, uuid, flags, read, write))
+
+    def get_properties(self):
+        return {
+            GATT_CHRC_IFACE: {
+                "Service": Variant("o", self.service.path),
+                "UUID": Variant("s", self.uuid),
+                "Flags": Variant("as", self.flags),
+                "Descriptors": Variant("ao", [desc.path for desc in self.descriptors]),
+            }
+        }
+
+    def notify_value(self, value):
+        self.value = bytes(fit_notification(value, type(self).__name__))
+        self.emit_properties_changed({"Value": self.value})
+        NOTIFICATIONS.inc(type(self).__name__)
+
+    def start_notify(self):
+        pass
+
+    def stop_notify(self):
+        pass
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Value(self) -> "ay":
+        return self.value
+
+    @method()
+    def StartNotify(self):
+        if not self.notifying:
+            self.notifying = True
+            self.start_notify()
+
+    @method()
+    def StopNotify(self):
+        self.notifying = False
+        self.stop_notify()
+
+
+class AioService(ServiceInterface):
+    PATH_BASE = "/org/bluez/example/service"
+
+    def __init__(self, index, uuid, primary=True):
+        ServiceInterface.__init__(self, GATT_SERVICE_IFACE)
+        self.index = index
+        self.path = self.PATH_BASE + str(index)
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+
+    def add_characteristic(self, characteristic):
+        self.characteristics.append(characteristic)
+
+    def get_objects(self):
+        objects = [self]
+        for chrc in self.characteristics:
+            objects.append(chrc)
+            objects.extend(chrc.descriptors)
+        return objects
+
+    def get_properties(self):
+        return {
+            GATT_SERVICE_IFACE: {
+                "UUID": Variant("s", self.uuid),
+                "Primary": Variant("b", self.primary),
+                "Characteristics": Variant("ao", [chrc.path for chrc in self.characteristics]),
+            }
+        }
+
+
+class AioMotorService(AioService):
+    def __init__(self, index, pvs, notifier, formats=None, policies=None, first_id=FIRST_AXIS_ID):
+        AioService.__init__(self, index, MOTOR_SVC_UUID)
+        self.notifier = notifier
+        self.axes = list(enumerate(pvs, first_id))
+        formats = formats or {}
+        policies = policies or {}
+        pos_fmt = check_format(formats.get("position", ASCII))
+        status_fmt = check_format(formats.get("status", ASCII))
+        digits = check_digits(formats.get("digits", DIGITS))
+        for id, pv in self.axes:
+            policy = NotifyPolicy(**policies.get(pv, {}))
+            axis = AioPosCharacteristic(self, pv, id, pos_fmt, status_fmt, policy, digits)
+            self.add_characteristic(axis)
+            self.add_characteristic(AioMovnCharacteristic(self, pv, id, status_fmt))
+            self.add_characteristic(AioMoveDoneCharacteristic(self, axis))
+            if histories.size:
+                self.add_characteristic(AioHistoryCharacteristic(self, axis))
+        if index == 0:
+            self.add_characteristic(AioRBPVCharacteristic(self))
+        self.status = AioAxesStatusCharacteristic(self, pvs)
+        self.add_characteristic(self.status)
+        self.add_characteristic(AioGroupMoveCharacteristic(self))
+
+    def get_axis(self, id):
+        return next(chrc for chrc in self.characteristics if isinstance(chrc, AioPosCharacteristic) and chrc.id == id)
+
+
+class AioPosCharacteristic(AioCharacteristic):
+    def __init__(self, service, pv_name, id, fmt=ASCII, status_fmt=ASCII, policy=None, digits=DIGITS):
+        AioCharacteristic.__init__(self, service, make_uuid(id, POSITION_UUID_GROUP), ["write", "read", "notify"])
+        self.pv_name = pv_name
+        self.id = id
+        self.fmt = fmt
+        self.digits = digits
+        self.status_fmt = status_fmt
+        self.last_value = None
+        self.gate = AioPolicyGate(policy or NotifyPolicy(), self.send_position, pv_name)
+        self.commands = AioCommandQueue(pv_name, service.notifier)
+        self.add_descriptor("2910", ["read"], read=self.read_desc)
+        self.add_descriptor("2911", ["read"], read=self.reader("VAL", self.encode_position))
+        self.add_descriptor("2912", ["read"], read=self.constant(encode_string(pv_name)))
+        self.add_descriptor("2913", ["read", "write"], read=self.reader("RLV", self.encode_position), write=self.move)
+        self.add_descriptor("2914", ["read"], read=self.reader("LVIO", self.encode_lvio))
+        self.add_descriptor("2915", ["write"], write=self.stop)
+        self.add_descriptor("2904", ["read"], read=self.constant(encode_presentation_format(fmt, digits)))
+
+    def reader(self, field, encode):
+        async def read(options):
+            return encode(await self.service.notifier.get(f"{self.pv_name}.{field}"))
+
+        return read
+
+    @staticmethod
+    def constant(value):
+        async def read(options):
+            return value
+
+        return read
+
+    def encode_position(self, position):
+        return encode_position(self.pv_name, position, self.fmt, self.digits)
+
+    async def read_desc(self, options):
+        axis = metadata.get(self.pv_name)
+
+        async def read():
+            if axis is not None and axis.desc is not None:
+                return axis.desc
+            return encode_string(await self.service.notifier.get(f"{self.pv_name}.DESC"))
+
+        return await read_blob(f"{self.pv_name}.DESC", options, read)
+
+    def encode_lvio(self, lvio):
+        return encode_lvio(lvio, self.status_fmt)
+
+    def send_position(self, position):
+        value = encode_notified_position(self.pv_name, position, self.fmt, self.digits)
+        if value is None or value == self.last_value:
+            return False
+
+        self.notify_value(value)
+        self.last_value = value
+        return True
+
+    def set_pos_callback(self, position):
+        if self.notifying and position is not None:
+            self.gate.update(position)
+
+    def start_notify(self):
+        self.last_value = None
+        self.gate.reset()
+        self.service.notifier.subscribe(f"{self.pv_name}.RBV", self.set_pos_callback)
+
+    def stop_notify(self):
+        self.gate.reset()
+        self.service.notifier.unsubscribe(f"{self.pv_name}.RBV", self.set_pos_callback)
+
+    async def read(self, options):
+        return self.encode_position(await self.service.notifier.get(f"{self.pv_name}.RBV"))
+
+    async def write(self, value, options):
+        await self.commands.check("VAL")
+        self.commands.move("VAL", decode_number(value, self.fmt, self.digits))
+
+    async def move(self, value, options):
+        await self.commands.check("RLV")
+        self.commands.move("RLV", decode_number(value, self.fmt, self.digits))
+
+    async def stop(self, value, options):
+        self.commands.stop(decode_string(value))
+
+
+class AioMovnCharacteristic(AioCharacteristic):
+    def __init__(self, service, pv_name, id, fmt=ASCII):
+        AioCharacteristic.__init__(self, service, make_uuid(id, MOVN_UUID_GROUP), ["read", "notify"])
+        self.pv_name = pv_name
+        self.fmt = fmt
+        self.moving = None
+        self.add_descriptor("2904", ["read"], read=AioPosCharacteristic.constant(encode_presentation_format(fmt, 0)))
+
+    def set_status_callback(self, movn):
+        if self.notifying and movn is not None:
+            status = encode_flag(movn, self.fmt)
+            if status != self.moving:
+                self.notify_value(status)
+                self.moving = status
+
+    def start_notify(self):
+        self.moving = None
+        self.service.notifier.subscribe(f"{self.pv_name}.MOVN", self.set_status_callback)
+
+    def stop_notify(self):
+        self.service.notifier.unsubscribe(f"{self.pv_name}.MOVN", self.set_status_callback)
+
+    async def read(self, options):
+        return encode_flag(await self.service.notifier.get(f"{self.pv_name}.MOVN"), self.fmt)
+
+
+class AioMoveDoneCharacteristic(AioCharacteristic):
+    """Same event as MoveDoneCharacteristic: final RBV and LVIO once the put of a move completes."""
+
+    def __init__(self, service, axis):
+        AioCharacteristic.__init__(self, service, make_uuid(axis.id, MOVE_DONE_UUID_GROUP), ["read", "notify"])
+        self.pv_name = axis.pv_name
+        self.value = encode_move_done(None, None, DONE)
+        axis.commands.add_done_listener(self.on_move_done)
+
+    def on_move_done(self, outcome):
+        asyncio.ensure_future(self.send(outcome))
+
+    async def send(self, outcome):
+        pv_names = [f"{self.pv_name}.{field}" for field in MOVE_DONE_FIELDS]
+        values = await caget(pv_names, timeout=FETCH_TIMEOUT, throw=False)
+        self.value = encode_move_done(*[value if value.ok else None for value in values], outcome)
+        if self.notifying:
+            self.notify_value(self.value)
+
+    async def read(self, options):
+        return self.value
+
+
+class AioHistoryCharacteristic(AioCharacteristic):
+    """Same window requests and chunked reads as HistoryCharacteristic."""
+
+    def __init__(self, service, axis):
+        AioCharacteristic.__init__(self, service, make_uuid(axis.id, HISTORY_UUID_GROUP), ["read", "write"])
+        self.pv_name = axis.pv_name
+        self.history = histories.create(axis.pv_name)
+        self.windows = HistoryWindows(axis.pv_name, self.history)
+        sessions.add_close_listener(self.windows.on_session_closed)
+
+    def start(self):
+        self.service.notifier.subscribe(f"{self.pv_name}.RBV", self.history.append)
+
+    async def read(self, options):
+        session = sessions.get(options)
+
+        async def read():
+            return self.windows.next_chunk(session)
+
+        return await read_blob(self.path, options, read)
+
+    async def write(self, value, options):
+        self.windows.request(sessions.get(options), value)
+
+
+class AioGroupMoveCharacteristic(AioCharacteristic):
+    """Same targets, checks and result as GroupMoveCharacteristic."""
+
+    def __init__(self, service):
+        AioCharacteristic.__init__(self, service, make_uuid(1, MOVE_UUID_GROUP), ["read", "write", "notify"])
+        self.seq = 0
+        self.value = encode_move_result(0, DONE)
+
+    async def get_moves(self, targets):
+        axes = {pv: self.service.get_axis(id) for id, pv in self.service.axes}
+        moves = [(axes[pv], target) for pv, target in get_group_targets(targets, self.service.status.frame.pvs)]
+        for chrc, _ in moves:
+            await chrc.commands.check("VAL")
+        return moves
+
+    def on_done(self, seq, outcome):
+        self.value = encode_move_result(seq, outcome)
+        if self.notifying:
+            self.notify_value(self.value)
+
+    async def read(self, options):
+        return self.value
+
+    async def write(self, value, options):
+        moves = await self.get_moves(decode_move_frame(value))
+        self.seq += 1
+        GroupMove(len(moves), partial(self.on_done, self.seq)).start(moves)
+
+
+class AioRBPVCharacteristic(AioCharacteristic):
+    def __init__(self, service):
+        AioCharacteristic.__init__(self, service, make_uuid(1, RBPV_UUID_GROUP), ["write", "read", "notify"])
+        self.watch_list = PVWatchList(service.notifier, self.notify_value)
+        sessions.add_close_listener(self.watch_list.on_session_closed)
+
+    def start_notify(self):
+        if not self.watch_list.watched:
+            self.notify_value(INVALID)
+        self.watch_list.start()
+
+    def stop_notify(self):
+        self.watch_list.stop()
+
+    async def read(self, options):
+        pv_name = sessions.get(options).custom_pv
+        return encode_string(pv_name) if pv_name else NO_PV
+
+    async def write(self, value, options):
+        session = sessions.get(options)
+        pv_name = decode_string(value)
+        pv_egu = self.watch_list.egus.get(pv_name)
+        if pv_egu is None:
+            try:
+                valid = await self.service.notifier.get(pv_name, timeout=VALIDATE_TIMEOUT)
+            except DBusError:
+                valid = None
+            if valid:
+                pv_egu = await self.service.notifier.get_units(pv_name, timeout=VALIDATE_TIMEOUT) or " "
+            else:
+                pv_name = None
+        self.watch_list.select(session, pv_name, pv_egu)
+
+
+class AioAxesStatusCharacteristic(AioCharacteristic):
+    def __init__(self, service, pvs):
+        AioCharacteristic.__init__(self, service, make_uuid(1, AXES_UUID_GROUP), ["read", "notify"])
+        self.frame = AxesFrame(service.notifier, self.notify_value, asyncio.get_event_loop().call_soon, pvs)
+
+    def start_notify(self):
+        self.frame.start()
+
+    def stop_notify(self):
+        self.frame.stop()
+
+    async def read(self, options):
+        return await read_blob(self.path, options, self.read_frame)
+
+    async def read_frame(self):
+        if self.notifying:
+            return self.frame.encode()
+
+        pv_names = self.frame.get_pv_names()
+        values = await asyncio.gather(
+            *(self.service.notifier.get(pv_name) for pv_name in pv_names), return_exceptions=True
+        )
+        return self.frame.encode(
+            {pv_name: value for pv_name, value in zip(pv_names, values) if not isinstance(value, Exception)}
+        )
+
+
+class AioAxisIndexCharacteristic(AioCharacteristic):
+    def __init__(self, service, services):
+        AioCharacteristic.__init__(self, service, make_uuid(1, INDEX_UUID_GROUP), ["read", "write"])
+        self.table = AxisTable(services)
+
+    async def read(self, options):
+        value = self.table.get(sessions.get(options))
+
+        async def read():
+            return value
+
+        return await read_blob(self.path, options, read)
+
+    async def write(self, value, options):
+        self.table.select(sessions.get(options), value)
+
+
+class AioDiagnosticsCharacteristic(AioCharacteristic):
+    def __init__(self, service):
+        AioCharacteristic.__init__(self, service, make_uuid(1, DIAG_UUID_GROUP), ["read"])
+
+    async def read(self, options):
+        async def read():
+            return encode_diagnostics()
+
+        return await read_blob(self.path, options, read)
+
+
+class AioApplication(ServiceInterface):
+    def __init__(self, services):
+        ServiceInterface.__init__(self, DBUS_OM_IFACE)
+        self.services = services
+
+    @method()
+    def GetManagedObjects(self) -> "a{oa{sa{sv}}}":
+        return {obj.path: obj.get_properties() for service in self.services for obj in service.get_objects()}
+
+    def export(self, bus):
+        bus.export("/", self)
+        for service in self.services:
+            for obj in service.get_objects():
+                bus.export(obj.path, obj)
+
+
+class AioAdvertisement(ServiceInterface):
+    PATH_BASE = "/org/bluez/example/advertisement"
+
+    def __init__(self, index, name="Generic Bluetooth Controller"):
+        ServiceInterface.__init__(self, LE_ADVERTISEMENT_IFACE)
+        self.path = self.PATH_BASE + str(index)
+        self.local_name = name
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Type(self) -> "s":
+        return "peripheral"
+
+    @dbus_property(access=PropertyAccess.READ)
+    def LocalName(self) -> "s":
+        return self.local_name
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ManufacturerData(self) -> "a{qv}":
+        return {0x000D: Variant("ay", bytes([0, 0]))}  # Texas Instruments
+
+    @dbus_property(access=PropertyAccess.READ)
+    def IncludeTxPower(self) -> "b":
+        return True
+
+    @method()
+    def Release(self):
+        print(f"{self.path}: released")
+
+
+def build_services(pvs, notifier, formats=None, policies=None, group_size=GROUP_SIZE):
+    services = [
+        AioMotorService(shard, pvs[start : start + group_size], notifier, formats, policies, FIRST_AXIS_ID + start)
+        for shard, start in enumerate(range(0, max(len(pvs), 1), group_size))
+    ]
+    services[0].add_characteristic(AioAxisIndexCharacteristic(services[0], services))
+    services[0].add_characteristic(AioDiagnosticsCharacteristic(services[0]))
+    return services
+
+
+async def get_interface(bus, path, interface):
+    introspection = await bus.introspect(BLUEZ_SERVICE_NAME, path)
+    return bus.get_proxy_object(BLUEZ_SERVICE_NAME, path, introspection).get_interface(interface)
+
+
+async def find_adapter(bus):
+    om = await get_interface(bus, "/", DBUS_OM_IFACE)
+    for path, interfaces in (await om.call_get_managed_objects()).items():
+        if LE_ADVERTISING_MANAGER_IFACE in interfaces:
+            return path
+    return None
+
+
+async def watch_sessions(bus):
+    rule = f"type='signal',interface='{DBUS_PROP_IFACE}',member='PropertiesChanged',arg0='{DEVICE_IFACE}'"
+    await bus.call(
+        Message(
+            destination="org.freedesktop.DBus",
+            path="/org/freedesktop/DBus",
+            interface="org.freedesktop.DBus",
+            member="AddMatch",
+            signature="s",
+            body=[rule],
+        )
+    )
+
+    def on_message(message):
+        if message.member != "PropertiesChanged" or not message.body or message.body[0] != DEVICE_IFACE:
+            return
+        connected = message.body[1].get("Connected")
+        if connected is not None and not connected.value:
+            sessions.close(message.path)
+
+    bus.add_message_handler(on_message)
+
+
+async def connect_axes(pvs, timeout):
+    values = await asyncio.gather(*(caget(pv, timeout=timeout, throw=False) for pv in pvs))
+    connected = []
+    for pv, value in zip(pvs, values):
+        if value.ok:
+            connected.append(pv)
+        else:
+            print(f"{pv} unreachable, axis not registered")
+    return connected
+
+
+async def load_metadata(pvs):
+    # The glib runtime's store, filled with caget here instead of the worker pool
+    metadata.add(pvs)
+    while True:
+        await fetch_metadata(pvs)
+        missing = [pv for pv in pvs if metadata.is_missing(pv)]
+        await asyncio.gather(asyncio.sleep(metadata.ttl), *(retry_metadata(pv, metadata.ttl) for pv in missing))
+
+
+async def fetch_metadata(pvs):
+    values = await caget(get_pv_names(pvs), timeout=FETCH_TIMEOUT, throw=False)
+    metadata.store(get_axes(pvs, [value if value.ok else None for value in values]))
+
+
+async def retry_metadata(pv, timeout):
+    # An axis that was not connected for the load is read once it connects, not a whole ttl later
+    if (await connect(f"{pv}.DESC", timeout=timeout, throw=False)).ok:
+        await fetch_metadata([pv])
+
+
+async def probe_lag(heartbeat=None):
+    while True:
+        expected = time.monotonic() + LAG_PROBE_PERIOD
+        await asyncio.sleep(LAG_PROBE_PERIOD)
+        MAINLOOP_LAG.observe(max(0.0, time.monotonic() - expected))
+        if heartbeat is not None:
+            heartbeat()
+
+
+async def serve(pvs, name, formats=None, policies=None, group_size=GROUP_SIZE, connect_timeout=None, **options):
+    if connect_timeout is not None:
+        pvs = await connect_axes(pvs, connect_timeout)
+
+    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+    if options.get("bus_name"):
+        await bus.request_name(options["bus_name"])
+    await watch_sessions(bus)
+
+    notifier = AioPVs()
+    services = build_services(pvs, notifier, formats, policies, group_size)
+    app = AioApplication(services)
+    app.export(bus)
+    adv = AioAdvertisement(0, name)
+    bus.export(adv.path, adv)
+
+    axes = [chrc for service in services for chrc in service.characteristics if isinstance(chrc, AioPosCharacteristic)]
+    registry.add_stats("commands", lambda: {chrc.pv_name: chrc.commands.get_stats() for chrc in axes}, "pv")
+    registry.add_stats("policy", lambda: {chrc.pv_name: chrc.gate.get_stats() for chrc in axes}, "pv")
+    registry.add_stats("aio", notifier.get_stats)
+    registry.add_stats("metadata", metadata.get_stats)
+    registry.add_stats("history", histories.get_stats)
+    asyncio.ensure_future(probe_lag(options.get("heartbeat")))
+
+    adapter = await find_adapter(bus)
+    service_manager = await get_interface(bus, adapter, GATT_MANAGER_IFACE)
+    ad_manager = await get_interface(bus, adapter, LE_ADVERTISING_MANAGER_IFACE)
+    await asyncio.gather(
+        service_manager.call_register_application("/", {}),
+        ad_manager.call_register_advertisement(adv.path, {}),
+    )
+    print("GATT application registered")
+    print("GATT advertisement registered")
+
+    # Recording and metadata reads only start once centrals can find us
+    for service in services:
+        for chrc in service.characteristics:
+            if isinstance(chrc, AioHistoryCharacteristic):
+                chrc.start()
+    asyncio.ensure_future(load_metadata(pvs))
+
+    await bus.wait_for_disconnect()
+
+
+def run(pvs, name, formats=None, policies=None, group_size=GROUP_SIZE, connect_timeout=None, **options):
+    try:
+        asyncio.run(serve(pvs, name, formats, policies, group_size, connect_timeout, **options))
+    except KeyboardInterrupt:
+        print("\nGATT application terminated")
@@ -1,11 +1,100 @@
-import dbus
-from epics import caget, caput
+import time
+from functools import partial
 
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
 from ble_motor_ctrl.advertisement import Advertisement
+from ble_motor_ctrl.backend import backends
+from ble_motor_ctrl.bletools import BleTools
+from ble_motor_ctrl.cache import FETCH_TIMEOUT, pv_cache
+from ble_motor_ctrl.commands import CommandQueue
+from ble_motor_ctrl.encoding import (
+    ASCII,
+    DIGITS,
+    INVALID,
+    NO_PV,
+    check_digits,
+    check_format,
+    decode_move_frame,
+    decode_number,
+    decode_string,
+    encode_flag,
+    encode_move_done,
+    encode_move_result,
+    encode_presentation_format,
+    encode_string,
+)
+from ble_motor_ctrl.history import histories
+from ble_motor_ctrl.metadata import get_axes, get_pv_names, metadata
+from ble_motor_ctrl.metrics import LAG_PROBE_PERIOD, MAINLOOP_LAG, registry, timed
+from ble_motor_ctrl.monitor import monitors, pollers
+from ble_motor_ctrl.policy import NotifyPolicy, PolicyGate
+from ble_motor_ctrl.pool import pv_pool
+from ble_motor_ctrl.protocol import (
+    AXES_UUID_GROUP,
+    CONNECT_TIMEOUT,
+    DIAG_UUID_GROUP,
+    DONE,
+    FIRST_AXIS_ID,
+    GROUP_SIZE,
+    HISTORY_UUID_GROUP,
+    INDEX_UUID_GROUP,
+    MOTOR_SVC_UUID,
+    MOVE_DONE_FIELDS,
+    MOVE_DONE_UUID_GROUP,
+    MOVE_UUID_GROUP,
+    MOVN_UUID_GROUP,
+    POSITION_UUID_GROUP,
+    RBPV_UUID_GROUP,
+    AxesFrame,
+    AxisTable,
+    GroupMove,
+    HistoryWindows,
+    PVWatchList,
+    encode_diagnostics,
+    encode_lvio,
+    encode_notified_position,
+    encode_position,
+    get_group_targets,
+    make_uuid,
+    read_long,
+)
+from ble_motor_ctrl.reload import ConfigWatcher
+from ble_motor_ctrl.sessions import sessions
+from ble_motor_ctrl.startup import startup
 from ble_motor_ctrl.service import Application, Service, Characteristic, Descriptor
+from ble_motor_ctrl.worker import read_pv, workers
 
-GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
-NOTIFY_TIMEOUT = 2000
+CONNECT_POLL = 50
+
+
+class GLibPolicyGate(PolicyGate):
+    def start_timer(self, delay, callback):
+        return GObject.timeout_add(int(delay * 1000) + 1, callback)
+
+    def cancel_timer(self, timer):
+        GObject.source_remove(timer)
+
+
+class LagProbe(object):
+    def __init__(self, period=LAG_PROBE_PERIOD, heartbeat=None):
+        self.period = period
+        self.heartbeat = heartbeat
+        self.expected = None
+
+    def start(self):
+        self.expected = time.monotonic() + self.period / 1000
+        GObject.timeout_add(self.period, self._on_timeout)
+
+    def _on_timeout(self):
+        now = time.monotonic()
+        MAINLOOP_LAG.observe(max(0.0, now - self.expected))
+        self.expected = now + self.period / 1000
+        if self.heartbeat is not None:
+            self.heartbeat()
+        return True
 
 
 class MotorAdvertisement(Advertisement):
@@ -17,65 +106,151 @@ class MotorAdvertisement(Advertisement):
 
 
 class MotorService(Service):
-    MOTOR_SVC_UUID = "84e7f883-7c80-4b64-88a5-6077ce2e8925"
+    MOTOR_SVC_UUID = MOTOR_SVC_UUID
 
-    def __init__(self, index, pvs):
+    def __init__(self, index, pvs, notifier=monitors, formats=None, policies=None, first_id=FIRST_AXIS_ID):
         Service.__init__(self, index, self.MOTOR_SVC_UUID, True)
-        for id, pv in enumerate(pvs, 2):
-            self.add_characteristic(PosCharacteristic(self, pv_name=pv, id=id))
-            self.add_characteristic(MovnCharacteristic(self, pv_name=pv, id=id))
-        self.add_characteristic(RBPVCharacteristic(self))
+        self.notifier = notifier
+        self.axes = []
+        self.status = None
+        formats = formats or {}
+        policies = policies or {}
+        self.pos_fmt = check_format(formats.get("position", ASCII))
+        self.status_fmt = check_format(formats.get("status", ASCII))
+        self.digits = check_digits(formats.get("digits", DIGITS))
+        for id, pv in enumerate(pvs, first_id):
+            self.add_axis(id, pv, policies.get(pv, {}))
+        if index == 0:
+            self.add_characteristic(RBPVCharacteristic(self))
+        self.status = AxesStatusCharacteristic(self, pvs)
+        self.add_characteristic(self.status)
+        self.add_characteristic(GroupMoveCharacteristic(self))
+
+    def add_axis(self, id, pv, policy=None):
+        self.axes.append((id, pv))
+        self.add_characteristic(
+            PosCharacteristic(
+                self,
+                pv_name=pv,
+                id=id,
+                fmt=self.pos_fmt,
+                status_fmt=self.status_fmt,
+                digits=self.digits,
+                policy=NotifyPolicy(**(policy or {})),
+            )
+        )
+        self.add_characteristic(MovnCharacteristic(self, pv_name=pv, id=id, fmt=self.status_fmt))
+        self.add_characteristic(MoveDoneCharacteristic(self, self.get_axis(id)))
+        if histories.size:
+            self.add_characteristic(HistoryCharacteristic(self, self.get_axis(id)))
+        if self.status is not None:
+            self.status.frame.add_pv(pv)
+
+    def remove_axis(self, id):
+        for axis_id, pv in self.axes:
+            if axis_id == id:
+                self.status.frame.remove_pv(pv)
+        self.axes = [(axis_id, pv) for axis_id, pv in self.axes if axis_id != id]
+        for chrc in [chrc for chrc in self.characteristics if getattr(chrc, "id", None) == id]:
+            if isinstance(chrc, HistoryCharacteristic):
+                chrc.stop()
+            else:
+                chrc.StopNotify()
+            if isinstance(chrc, PosCharacteristic):
+                chrc.commands.close()
+            self.remove_characteristic(chrc)
+
+    def start_axis(self, id):
+        # Started with the PV connections, so nothing connects before advertising
+        self.get_axis(id).commands.open()
+        for chrc in self.characteristics:
+            if isinstance(chrc, HistoryCharacteristic) and chrc.id == id:
+                chrc.start()
+
+    def get_axis(self, id):
+        return next(chrc for chrc in self.characteristics if isinstance(chrc, PosCharacteristic) and chrc.id == id)
 
 
 class PosCharacteristic(Characteristic):
-    def __init__(self, service, pv_name="IOC:m1", id=2):
+    def __init__(self, service, pv_name="IOC:m1", id=2, fmt=ASCII, status_fmt=ASCII, policy=None, digits=DIGITS):
         self.notifying = False
-        self.POS_CHARACTERISTIC_UUID = f"0000000{id}-710e-4a5b-8d75-3e5b444bc3cf"
+        self.POS_CHARACTERISTIC_UUID = make_uuid(id, POSITION_UUID_GROUP)
 
         Characteristic.__init__(self, self.POS_CHARACTERISTIC_UUID, ["write", "read", "notify"], service)
+        self.id = id
         self.pv_name = pv_name
+        self.fmt = fmt
+        self.digits = digits
         self.value = 0
+        self.policy = policy or NotifyPolicy()
+        self.gate = GLibPolicyGate(self.policy, self.send_position, pv_name)
+        self.commands = CommandQueue(pv_name)
         self.add_descriptor(DescDescriptor(self))
         self.add_descriptor(TargetPosDescriptor(self))
         self.add_descriptor(PVDescriptor(self))
         self.add_descriptor(RlvPosDescriptor(self))
-        self.add_descriptor(LvioDescriptor(self))
+        self.add_descriptor(LvioDescriptor(self, status_fmt))
         self.add_descriptor(StopDescriptor(self))
+        self.add_descriptor(PresentationFormatDescriptor(self, fmt, digits))
+
+    def encode_position(self, position):
+        return encode_position(self.pv_name, position, self.fmt, self.digits)
+
+    def send_position(self, position):
+        value = encode_notified_position(self.pv_name, position, self.fmt, self.digits)
+        if value is None or value == self.value:
+            return False
 
-    def get_position(self):
-        strtemp = str(round(caget(f"{self.pv_name}.RBV", timeout=1), 5))
-        return [dbus.Byte(c.encode()) for c in strtemp]
+        self.notify_value(value)
+        self.value = value
+        return True
 
-    def set_pos_callback(self):
+    def set_pos_callback(self, position):
+        if self.notifying and position is not None:
+            self.gate.update(position)
+
+    def set_policy(self, policy):
+        self.policy = policy
+        self.gate.policy = policy
+        self.gate.reset()
         if self.notifying:
-            value = self.get_position()
-            if value != self.value:
-                self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-                self.value = value
+            self.service.notifier.unsubscribe(f"{self.pv_name}.MOVN", self.set_moving_callback)
+            if policy.is_adaptive():
+                self.service.notifier.subscribe(f"{self.pv_name}.MOVN", self.set_moving_callback)
 
-        return self.notifying
+    def set_moving_callback(self, movn):
+        if self.notifying and movn is not None:
+            period = self.policy.get_period(bool(float(movn)))
+            self.service.notifier.set_period(f"{self.pv_name}.RBV", self.set_pos_callback, period)
 
     def StartNotify(self):
         if self.notifying:
             return
 
         self.notifying = True
-
-        value = self.get_position()
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        self.add_timeout(NOTIFY_TIMEOUT, self.set_pos_callback)
+        self.value = None
+        self.gate.reset()
+        self.service.notifier.subscribe(f"{self.pv_name}.RBV", self.set_pos_callback)
+        if self.policy.is_adaptive():
+            self.service.notifier.subscribe(f"{self.pv_name}.MOVN", self.set_moving_callback)
 
     def StopNotify(self):
         self.notifying = False
+        self.gate.reset()
+        self.service.notifier.unsubscribe(f"{self.pv_name}.RBV", self.set_pos_callback)
+        self.service.notifier.unsubscribe(f"{self.pv_name}.MOVN", self.set_moving_callback)
 
-    def ReadValue(self, options):
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
         # Real pos
-        return self.get_position()
+        read_pv(f"{self.pv_name}.RBV", self.encode_position, reply_handler, error_handler)
 
-    def WriteValue(self, value, options):
+    @timed
+    def WriteValue(self, value, options, reply_handler, error_handler):
         # Target pos
-        caput(self.pv_name, "".join([str(v) for v in value]))
-        return value
+        self.commands.check("VAL")
+        self.commands.move("VAL", decode_number(value, self.fmt, self.digits))
+        reply_handler()
 
 
 class DescDescriptor(Descriptor):
@@ -85,14 +260,18 @@ class DescDescriptor(Descriptor):
         self.characteristic = characteristic
         Descriptor.__init__(self, self.POS_DESCRIPTOR_UUID, ["read"], characteristic)
 
-    def ReadValue(self, options):
-        value = []
-        desc = caget(f"{self.characteristic.pv_name}.DESC", timeout=1)
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        pv_name = self.characteristic.pv_name
+        axis = metadata.get(pv_name)
 
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
+        def read(reply, error):
+            if axis is not None and axis.desc is not None:
+                reply(axis.desc)
+            else:
+                read_pv(f"{pv_name}.DESC", encode_string, reply, error)
 
-        return value
+        read_long(self.path, options, read, reply_handler, error_handler)
 
 
 class TargetPosDescriptor(Descriptor):
@@ -102,9 +281,11 @@ class TargetPosDescriptor(Descriptor):
         self.characteristic = characteristic
         Descriptor.__init__(self, self.POS_DESCRIPTOR_UUID, ["read"], characteristic)
 
-    def ReadValue(self, options):
-        strtemp = str(round(caget(f"{self.characteristic.pv_name}.VAL", timeout=1), 5))
-        return [dbus.Byte(c.encode()) for c in strtemp]
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        read_pv(
+            f"{self.characteristic.pv_name}.VAL", self.characteristic.encode_position, reply_handler, error_handler
+        )
 
 
 class PVDescriptor(Descriptor):
@@ -112,10 +293,12 @@ class PVDescriptor(Descriptor):
 
     def __init__(self, characteristic):
         self.characteristic = characteristic
+        self.value = encode_string(characteristic.pv_name)
         Descriptor.__init__(self, self.POS_DESCRIPTOR_UUID, ["read"], characteristic)
 
-    def ReadValue(self, options):
-        return [dbus.Byte(c.encode()) for c in self.characteristic.pv_name]
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        reply_handler(self.value)
 
 
 class RlvPosDescriptor(Descriptor):
@@ -125,31 +308,35 @@ class RlvPosDescriptor(Descriptor):
         self.characteristic = characteristic
         Descriptor.__init__(self, self.POS_DESCRIPTOR_UUID, ["read", "write"], characteristic)
 
-    def ReadValue(self, options):
-        try:
-            strtemp = str(round(caget(f"{self.characteristic.pv_name}.RLV", timeout=1), 5))
-            return [dbus.Byte(c.encode()) for c in strtemp]
-        except Exception as e:
-            print(e)
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        read_pv(
+            f"{self.characteristic.pv_name}.RLV", self.characteristic.encode_position, reply_handler, error_handler
+        )
 
-    def WriteValue(self, value, options):
-        caput(self.characteristic.pv_name + ".RLV", "".join([str(v) for v in value]))
-        return value
+    @timed
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        self.characteristic.commands.check("RLV")
+        self.characteristic.commands.move(
+            "RLV", decode_number(value, self.characteristic.fmt, self.characteristic.digits)
+        )
+        reply_handler()
 
 
 class LvioDescriptor(Descriptor):
     POS_DESCRIPTOR_UUID = "2914"
 
-    def __init__(self, characteristic):
+    def __init__(self, characteristic, fmt=ASCII):
         self.characteristic = characteristic
+        self.fmt = fmt
         Descriptor.__init__(self, self.POS_DESCRIPTOR_UUID, ["read"], characteristic)
 
-    def ReadValue(self, options):
-        try:
-            strtemp = str(caget(f"{self.characteristic.pv_name}.LVIO", timeout=1))
-            return [dbus.Byte(c.encode()) for c in strtemp]
-        except Exception as e:
-            print(e)
+    def encode_lvio(self, lvio):
+        return encode_lvio(lvio, self.fmt)
+
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        read_pv(f"{self.characteristic.pv_name}.LVIO", self.encode_lvio, reply_handler, error_handler)
 
 
 class StopDescriptor(Descriptor):
@@ -159,111 +346,574 @@ class StopDescriptor(Descriptor):
         self.characteristic = characteristic
         Descriptor.__init__(self, self.POS_DESCRIPTOR_UUID, ["write"], characteristic)
 
-    def WriteValue(self, value, options):
-        caput(self.characteristic.pv_name + ".STOP", "".join([str(v) for v in value]))
-        return value
+    @timed
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        self.characteristic.commands.stop(decode_string(value))
+        reply_handler()
+
+
+class PresentationFormatDescriptor(Descriptor):
+    POS_DESCRIPTOR_UUID = "2904"
+
+    def __init__(self, characteristic, fmt=ASCII, digits=DIGITS):
+        self.characteristic = characteristic
+        self.value = encode_presentation_format(fmt, digits)
+        Descriptor.__init__(self, self.POS_DESCRIPTOR_UUID, ["read"], characteristic)
+
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        reply_handler(self.value)
 
 
 class MovnCharacteristic(Characteristic):
-    def __init__(self, service, pv_name="IOC:m1", id=2):
+    def __init__(self, service, pv_name="IOC:m1", id=2, fmt=ASCII):
         self.notifying = False
-        self.POS_CHARACTERISTIC_UUID = f"0000000{id}-710f-4a5b-8d75-3e5b444bc3cf"
+        self.POS_CHARACTERISTIC_UUID = make_uuid(id, MOVN_UUID_GROUP)
 
         Characteristic.__init__(self, self.POS_CHARACTERISTIC_UUID, ["read", "notify"], service)
+        self.id = id
         self.pv_name = pv_name
-        self.moving = 0
+        self.fmt = fmt
+        self.moving = None
+        self.add_descriptor(PresentationFormatDescriptor(self, fmt, 0))
 
-    def get_status(self):
-        strtemp = "1" if float(caget(f"{self.pv_name}.MOVN", timeout=1)) else "0"
-        return [dbus.Byte(c.encode()) for c in strtemp]
+    def encode_status(self, movn):
+        return encode_flag(movn, self.fmt)
 
-    def set_status_callback(self):
-        if self.notifying:
-            status = self.get_status()
+    def set_status_callback(self, movn):
+        if self.notifying and movn is not None:
+            status = self.encode_status(movn)
             if status != self.moving:
-                self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": status}, [])
+                self.notify_value(status)
                 self.moving = status
 
-        return self.notifying
-
     def StartNotify(self):
         if self.notifying:
             return
 
         self.notifying = True
+        self.moving = None
+        self.service.notifier.subscribe(f"{self.pv_name}.MOVN", self.set_status_callback)
+
+    def StopNotify(self):
+        self.notifying = False
+        self.service.notifier.unsubscribe(f"{self.pv_name}.MOVN", self.set_status_callback)
+
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        read_pv(f"{self.pv_name}.MOVN", self.encode_status, reply_handler, error_handler)
 
-        status = self.get_status()
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": status}, [])
-        self.add_timeout(NOTIFY_TIMEOUT, self.set_status_callback)
+
+class MoveDoneCharacteristic(Characteristic):
+    """
+    Notifies the end of every move of an axis, group moves included, as soon as the IOC
+    completes its put: the motor record does so when the move is done, DMOV 1, so no
+    .MOVN update has to be waited for. The event carries the final RBV and LVIO.
+    """
+
+    def __init__(self, service, axis):
+        self.notifying = False
+        self.MOVE_DONE_CHARACTERISTIC_UUID = make_uuid(axis.id, MOVE_DONE_UUID_GROUP)
+
+        Characteristic.__init__(self, self.MOVE_DONE_CHARACTERISTIC_UUID, ["read", "notify"], service)
+        self.id = axis.id
+        self.pv_name = axis.pv_name
+        self.value = encode_move_done(None, None, DONE)
+        axis.commands.add_done_listener(self.on_move_done)
+
+    def on_move_done(self, outcome):
+        pv_names = [f"{self.pv_name}.{field}" for field in MOVE_DONE_FIELDS]
+
+        def fetch():
+            values = backends.get_many(pv_names, FETCH_TIMEOUT)
+            for pv_name, value in zip(pv_names, values):
+                pv_cache.update(pv_name, value)
+            return values
+
+        workers.submit(
+            self.pv_name,
+            fetch,
+            lambda values: self.send(outcome, *values),
+            lambda e: self.send(outcome, None, None),
+        )
+
+    def send(self, outcome, rbv, lvio):
+        self.value = encode_move_done(rbv, lvio, outcome)
+        if self.notifying:
+            self.notify_value(self.value)
+
+    def StartNotify(self):
+        self.notifying = True
 
     def StopNotify(self):
         self.notifying = False
 
-    def ReadValue(self, options):
-        return self.get_status()
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        reply_handler(self.value)
+
+
+class HistoryCharacteristic(Characteristic):
+    """
+    Position history of an axis, recorded whether or not anyone is subscribed. A client
+    writes a window and then reads the samples in it, in chunks, one chunk per read.
+    """
+
+    def __init__(self, service, axis):
+        self.HISTORY_CHARACTERISTIC_UUID = make_uuid(axis.id, HISTORY_UUID_GROUP)
+
+        Characteristic.__init__(self, self.HISTORY_CHARACTERISTIC_UUID, ["read", "write"], service)
+        self.id = axis.id
+        self.pv_name = axis.pv_name
+        self.history = histories.create(axis.pv_name)
+        self.windows = HistoryWindows(axis.pv_name, self.history)
+        sessions.add_close_listener(self.windows.on_session_closed)
+
+    def start(self):
+        # Started with the PV connections, so recording never delays advertising
+        self.service.notifier.subscribe(f"{self.pv_name}.RBV", self.history.append)
+
+    def stop(self):
+        self.service.notifier.unsubscribe(f"{self.pv_name}.RBV", self.history.append)
+        sessions.remove_close_listener(self.windows.on_session_closed)
+        histories.remove(self.pv_name)
+
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        session = sessions.get(options)
+        read_long(
+            self.path,
+            options,
+            lambda reply, error: reply(self.windows.next_chunk(session)),
+            reply_handler,
+            error_handler,
+        )
+
+    @timed
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        self.windows.request(sessions.get(options), value)
+        reply_handler()
+
+
+class PooledWatchList(PVWatchList):
+    def hold(self, pv_name):
+        # Held in the pool so switching back and forth never reconnects it
+        pv_pool.acquire(pv_name)
+
+    def release(self, pv_name):
+        pv_pool.release(pv_name)
 
 
 class RBPVCharacteristic(Characteristic):
     def __init__(self, service):
         self.notifying = False
-        self.RBPV_CHARACTERISTIC_UUID = "00000001-7110-4a5b-8d75-3e5b444bc3cf"
+        self.RBPV_CHARACTERISTIC_UUID = make_uuid(1, RBPV_UUID_GROUP)
 
         Characteristic.__init__(self, self.RBPV_CHARACTERISTIC_UUID, ["write", "read", "notify"], service)
-        self.pv_name = None
-        self.pv_egu = ""
-        self.pv_value = ""
-
-    def get_value(self):
-        strtemp = f"{str(caget(self.pv_name, timeout=0.3) or 'Invalid')} {self.pv_egu}"
-        return [dbus.Byte(c.encode()) for c in strtemp]
+        self.watch_list = PooledWatchList(service.notifier, self.notify_value)
+        sessions.add_close_listener(self.watch_list.on_session_closed)
 
-    def set_value_callback(self):
+    def StartNotify(self):
         if self.notifying:
-            if self.pv_name:
-                value = self.get_value()
-                self.pv_value = value
-            else:
-                value = [dbus.Byte(c.encode()) for c in "Invalid"]
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+            return
+
+        self.notifying = True
+        if not self.watch_list.watched:
+            self.notify_value(INVALID)
+
+        for pv_name in self.watch_list.watched:
+            info = pv_pool.peek_metadata(pv_name)
+            if info is not None:
+                self.watch_list.egus[pv_name] = info["egu"] or " "
+        self.watch_list.start()
+
+    def StopNotify(self):
+        self.notifying = False
+        self.watch_list.stop()
+
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        pv_name = sessions.get(options).custom_pv
+        value = encode_string(pv_name) if pv_name else NO_PV
+        read_long(self.path, options, lambda reply, error: reply(value), reply_handler, error_handler)
+
+    @timed
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        session = sessions.get(options)
+        pv_name = decode_string(value)
+
+        def validate():
+            pv = pv_pool.connect(pv_name, timeout=0.5)
+            if pv is not None and pv.get(timeout=0.5):
+                info = pv_pool.get_metadata(pv_name, timeout=0.5) or {}
+                return pv_name, info.get("egu") or " "
+            return None, None
+
+        def selected(result):
+            self.watch_list.select(session, *result)
+            reply_handler()
+
+        info = pv_pool.peek_metadata(pv_name)
+        if info is not None:
+            selected((pv_name, info["egu"] or " "))
+        else:
+            workers.submit(pv_name, validate, selected, error_handler)
 
-        return self.notifying
+
+class AxesStatusCharacteristic(Characteristic):
+    def __init__(self, service, pvs):
+        self.notifying = False
+        self.AXES_CHARACTERISTIC_UUID = make_uuid(1, AXES_UUID_GROUP)
+
+        Characteristic.__init__(self, self.AXES_CHARACTERISTIC_UUID, ["read", "notify"], service)
+        self.frame = AxesFrame(service.notifier, self.notify_value, GObject.idle_add, pvs)
 
     def StartNotify(self):
         if self.notifying:
             return
 
-        if self.pv_name:
-            self.pv_egu = caget(self.pv_name + ".EGU", timeout=0.1) or " "
-            value = self.get_value()
-        else:
-            value = [dbus.Byte(c.encode()) for c in "Invalid"]
+        self.notifying = True
+        self.frame.start()
+
+    def StopNotify(self):
+        self.notifying = False
+        self.frame.stop()
+
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        def read(reply, error):
+            if self.notifying:
+                reply(self.frame.encode())
+                return
+
+            def fetch():
+                values = {}
+                for pv_name in self.frame.get_pv_names():
+                    hit, value = pv_cache.lookup(pv_name)
+                    if hit:
+                        values[pv_name] = value
+
+                # Every field missing from the cache is read in a single batched request
+                misses = [pv_name for pv_name in self.frame.get_pv_names() if pv_name not in values]
+                if misses:
+                    for pv_name, value in zip(misses, backends.get_many(misses, FETCH_TIMEOUT)):
+                        pv_cache.update(pv_name, value)
+                        values[pv_name] = value
+                return self.frame.encode(values)
+
+            workers.submit(self.path, fetch, reply, error)
+
+        # A full frame is longer than one ATT read, the Read Blobs that follow are served from its snapshot
+        read_long(self.path, options, read, reply_handler, error_handler)
+
+
+class GroupMoveCharacteristic(Characteristic):
+    """
+    Moves several axes of the service with one write. Targets are given per axes status
+    slot, checked against the soft limits all at once, and then issued together. A result
+    with the sequence number of the write is notified once every axis is done.
+    """
+
+    def __init__(self, service):
+        self.notifying = False
+        self.MOVE_CHARACTERISTIC_UUID = make_uuid(1, MOVE_UUID_GROUP)
 
+        Characteristic.__init__(self, self.MOVE_CHARACTERISTIC_UUID, ["read", "write", "notify"], service)
+        self.seq = 0
+        self.value = encode_move_result(0, DONE)
+
+    def get_moves(self, targets):
+        axes = {pv: self.service.get_axis(id) for id, pv in self.service.axes}
+        moves = [(axes[pv], target) for pv, target in get_group_targets(targets, self.service.status.frame.pvs)]
+        for chrc, _ in moves:
+            chrc.commands.check("VAL")
+        return moves
+
+    def on_done(self, seq, outcome):
+        self.value = encode_move_result(seq, outcome)
+        if self.notifying:
+            self.notify_value(self.value)
+
+    def StartNotify(self):
         self.notifying = True
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        self.add_timeout(NOTIFY_TIMEOUT, self.set_value_callback)
 
     def StopNotify(self):
         self.notifying = False
 
-    def ReadValue(self, options):
-        return [dbus.Byte(c.encode()) for c in self.pv_name or "No PV"]
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        reply_handler(self.value)
 
-    def WriteValue(self, value, options):
-        self.pv_name = "".join([str(v) for v in value])
-        if caget(self.pv_name, timeout=0.5):
-            self.pv_egu = caget(self.pv_name + ".EGU", timeout=0.1) or " "
-        else:
-            self.pv_name = None
-        return value
+    @timed
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        # Nothing moves unless every target is valid
+        moves = self.get_moves(decode_move_frame(value))
+        self.seq += 1
+        GroupMove(len(moves), partial(self.on_done, self.seq)).start(moves)
+        reply_handler()
 
 
-def register(pvs, name):
-    app = Application()
-    app.add_service(MotorService(0, pvs))
-    app.register()
+class AxisIndexCharacteristic(Characteristic):
+    def __init__(self, service, services):
+        self.INDEX_CHARACTERISTIC_UUID = make_uuid(1, INDEX_UUID_GROUP)
+
+        Characteristic.__init__(self, self.INDEX_CHARACTERISTIC_UUID, ["read", "write"], service)
+        self.table = AxisTable(services)
+
+    def add_axis(self, id, shard, pv):
+        self.table.add_axis(id, shard, pv)
+
+    def remove_axis(self, id):
+        self.table.remove_axis(id)
+
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        value = self.table.get(sessions.get(options))
+        read_long(self.path, options, lambda reply, error: reply(value), reply_handler, error_handler)
 
+    @timed
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        self.table.select(sessions.get(options), value)
+        reply_handler()
+
+
+class DiagnosticsCharacteristic(Characteristic):
+    def __init__(self, service):
+        self.DIAG_CHARACTERISTIC_UUID = make_uuid(1, DIAG_UUID_GROUP)
+
+        Characteristic.__init__(self, self.DIAG_CHARACTERISTIC_UUID, ["read"], service)
+
+    @timed
+    def ReadValue(self, options, reply_handler, error_handler):
+        value = encode_diagnostics()
+        read_long(self.path, options, lambda reply, error: reply(value), reply_handler, error_handler)
+
+
+def build_services(pvs, notifier=monitors, formats=None, policies=None, group_size=GROUP_SIZE):
+    services = [
+        MotorService(shard, pvs[start : start + group_size], notifier, formats, policies, FIRST_AXIS_ID + start)
+        for shard, start in enumerate(range(0, max(len(pvs), 1), group_size))
+    ]
+    services[0].add_characteristic(AxisIndexCharacteristic(services[0], services))
+    services[0].add_characteristic(DiagnosticsCharacteristic(services[0]))
+    return services
+
+
+def add_stats(services):
+    registry.add_stats("cache", pv_cache.get_stats)
+    registry.add_stats("pool", pv_pool.get_stats)
+    registry.add_stats("workers", lambda: {"depth": workers.get_depth()})
+    registry.add_stats("metadata", metadata.get_stats)
+    registry.add_stats("history", histories.get_stats)
+
+    def get_commands_stats():
+        # Read from the services on every scrape, as axes come and go with config reloads
+        return {pv: service.get_axis(id).commands.get_stats() for service in services for id, pv in service.axes}
+
+    registry.add_stats("commands", get_commands_stats, "pv")
+
+    def get_policy_stats():
+        return {pv: service.get_axis(id).gate.get_stats() for service in services for id, pv in service.axes}
+
+    registry.add_stats("policy", get_policy_stats, "pv")
+
+
+def find_index(services):
+    return next(chrc for chrc in services[0].characteristics if isinstance(chrc, AxisIndexCharacteristic))
+
+
+def load_metadata(pvs):
+    """Reads the metadata of pvs on the worker pool, in one batched request."""
+    pvs = list(pvs)
+    if not pvs:
+        return
+
+    def fetch():
+        return get_axes(pvs, backends.get_many(get_pv_names(pvs), FETCH_TIMEOUT))
+
+    workers.submit("metadata", fetch, metadata.store, lambda e: None)
+
+
+def refresh_metadata():
+    load_metadata(metadata.pvs)
+    return True
+
+
+def retry_metadata(pv_name):
+    if metadata.is_missing(pv_name):
+        load_metadata([pv_name])
+    return False
+
+
+def on_connection(start, pv_name, conn=False, **kwargs):
+    if conn:
+        print(f"{pv_name} connected in {(time.monotonic() - start) * 1000:.1f} ms")
+        # Called from the CA thread; a load that failed before the axis connected is not left to the ttl
+        GObject.idle_add(retry_metadata, pv_name)
+    else:
+        print(f"{pv_name} disconnected")
+
+
+def connect_axes(app, services, timeout=CONNECT_TIMEOUT, lazy=False):
+    """
+    Connects the PVs of every axis in the background. Unless lazy, axes still unconnected
+    after timeout seconds are removed from the GATT tree, and their services announced again.
+    """
+    start = time.monotonic()
+    index = find_index(services)
+    channels = []
+    for service in services:
+        for id, pv in service.axes:
+            channel = pv_pool.acquire(pv)
+            callback = partial(on_connection, start, pv)
+            channel.connection_callbacks.append(callback)
+            channels.append((service, id, pv, channel, callback))
+            service.start_axis(id)
+
+    def remove(service, pending):
+        for _, id, pv, channel, callback in pending:
+            print(f"{pv} unreachable, axis removed")
+            service.remove_axis(id)
+            index.remove_axis(id)
+            channel.connection_callbacks.remove(callback)
+            pv_pool.release(pv)
+
+    def check():
+        pending = [axis for axis in channels if not axis[3].connected]
+        if pending and time.monotonic() - start < timeout:
+            return True
+
+        if not lazy:
+            for service in services:
+                unreachable = [axis for axis in pending if axis[0] is service]
+                if unreachable:
+                    app.update_service(service, partial(remove, service, unreachable))
+        startup.mark("connect")
+        startup.report()
+        load_metadata(metadata.add([pv for service in services for _, pv in service.axes]))
+        GObject.timeout_add_seconds(metadata.ttl, refresh_metadata)
+        return False
+
+    GObject.timeout_add(CONNECT_POLL, check)
+
+
+class AxisSet(object):
+    """
+    Applies a new list of axes to the running application. Only added and removed axes create
+    or unexport D-Bus objects, so the other axes keep their objects, UUIDs, subscriptions and
+    history. BlueZ only follows whole services, so added axes always get new services and a
+    service that loses an axis is announced again. Ids of removed axes are never reused.
+    """
+
+    def __init__(self, app, services, notifier=monitors, formats=None, policies=None, group_size=GROUP_SIZE):
+        self.app = app
+        self.services = services
+        self.notifier = notifier
+        self.formats = formats
+        self.group_size = group_size
+        self.index = find_index(services)
+        self.policies = {pv: (policies or {}).get(pv, {}) for service in services for _, pv in service.axes}
+        self.next_id = FIRST_AXIS_ID + len(self.policies)
+
+    def get_axes(self):
+        return {pv: (service, id) for service in self.services for id, pv in service.axes}
+
+    def update(self, pvs, policies=None):
+        policies = {pv: (policies or {}).get(pv, {}) for pv in pvs}
+        axes = self.get_axes()
+        for pv, (service, id) in axes.items():
+            if pv not in policies:
+                self.remove(service, id, pv)
+
+        for pv, policy in policies.items():
+            if pv in axes and policy != self.policies.get(pv):
+                service, id = axes[pv]
+                service.get_axis(id).set_policy(NotifyPolicy(**policy))
+                print(f"{pv} notification policy updated")
+        added = [pv for pv in policies if pv not in axes]
+        self.add(added, policies)
+        load_metadata(metadata.add(added))
+        self.policies = policies
+
+    def remove(self, service, id, pv):
+        self.app.update_service(service, partial(service.remove_axis, id))
+        self.index.remove_axis(id)
+        pv_pool.release(pv)
+        metadata.remove(pv)
+        print(f"{pv} removed")
+
+    def add(self, pvs, policies):
+        pvs = list(pvs)
+        start = time.monotonic()
+        for pv in pvs:
+            pv_pool.acquire(pv).connection_callbacks.append(partial(on_connection, start, pv))
+
+        # Filling an existing service would announce it again and drop its notifying clients
+        for first in range(0, len(pvs), self.group_size):
+            shard = pvs[first : first + self.group_size]
+            # Built whole before it is exported, so BlueZ sees the service with all its characteristics
+            service = MotorService(len(self.services), shard, self.notifier, self.formats, policies, self.next_id)
+            self.services.append(service)
+            self.app.add_service(service)
+            for id, pv in service.axes:
+                self.added(service, id, pv)
+
+    def added(self, service, id, pv):
+        service.start_axis(id)
+        self.index.add_axis(id, service.index, pv)
+        self.next_id = max(self.next_id, id + 1)
+        print(f"{pv} added as axis {id:08x}")
+
+
+def register(
+    pvs,
+    name,
+    notify_mode="monitor",
+    formats=None,
+    policies=None,
+    group_size=GROUP_SIZE,
+    connect_timeout=CONNECT_TIMEOUT,
+    lazy_axes=False,
+    config_path=None,
+    load_axes=None,
+    heartbeat=None,
+):
+    """
+    Serves the axes until interrupted. With a config_path, changes to that file are applied
+    in place: load_axes is called to read it and returns the new PV list and policies.
+    heartbeat is called from the main loop, as the watchdog expects.
+    """
+    app = Application()
+    startup.mark("bus")
+    adapter = BleTools.find_adapter(app.bus)
+    startup.mark("adapter")
+
+    sessions.watch(app.bus)
+    notifier = pollers if notify_mode == "poll" else monitors
+    services = build_services(pvs, notifier, formats, policies, group_size)
+    for service in services:
+        app.add_service(service)
+    add_stats(services)
+    registry.add_stats("startup", startup.get_stats)
+    axes = AxisSet(app, services, notifier, formats, policies, group_size)
+    watcher = ConfigWatcher(config_path, lambda: axes.update(*load_axes())) if config_path else None
     adv = MotorAdvertisement(0, name)
-    adv.register()
+    startup.mark("services")
+
+    pending = {app, adv}
+
+    def registered(obj):
+        # PV connections only start once centrals can find us
+        pending.discard(obj)
+        if not pending:
+            startup.mark("register")
+            connect_axes(app, services, connect_timeout, lazy_axes)
+            if watcher is not None:
+                watcher.start()
+
+    app.register(adapter, partial(registered, app))
+    adv.register(adapter, partial(registered, adv))
+    LagProbe(heartbeat=heartbeat).start()
 
     try:
         app.run()
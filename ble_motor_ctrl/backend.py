@@ -0,0 +1,278 @@
+import threading
+
+try:
+    from p4p.client.thread import Context
+except ImportError:
+    Context = None
+
+DEFAULT_BACKEND = "ca"
+PUT_TIMEOUT = 60.0
+GROUP_FIELDS = {"RBV": "rbv", "MOVN": "movn", "LVIO": "lvio"}
+METADATA_FIELDS = {
+    "units": "display.units",
+    "precision": "display.precision",
+    "lower_ctrl_limit": "control.limitLow",
+    "upper_ctrl_limit": "control.limitHigh",
+}
+
+
+def get_field(value, path):
+    try:
+        return value[path]
+    except (KeyError, AttributeError, TypeError):
+        return None
+
+
+def unwrap(value):
+    field = get_field(value, "value")
+    # NTEnum, such as a motor record field served as an enum, holds its state in value.index
+    index = get_field(field, "index")
+    return index if index is not None else field
+
+
+class CABackend(object):
+    """Channel Access through pyepics, whose PV objects are the channel interface."""
+
+    def __init__(self):
+        # Imported with the first PV, so that loading libca never delays advertising
+        import epics
+
+        self.epics = epics
+
+    def create(self, pv_name):
+        return self.epics.get_pv(pv_name, connect=False, auto_monitor=True)
+
+    def get(self, pv_name, timeout):
+        return self.epics.caget(pv_name, timeout=timeout, connection_timeout=timeout)
+
+    def get_many(self, pv_names, timeout):
+        return self.epics.caget_many(pv_names, timeout=timeout, connection_timeout=timeout)
+
+
+class PVAChannel(object):
+    """
+    A pvAccess monitor behind the subset of the pyepics PV interface the application uses:
+    value and connection callbacks, connection waits, reads, control metadata and puts.
+    """
+
+    def __init__(self, context, pvname):
+        self.context = context
+        self.pvname = pvname
+        self.value = None
+        self.structure = None
+        self.connected = False
+        self.connection_event = threading.Event()
+        self.callbacks = {}
+        self.next_index = 0
+        self.connection_callbacks = []
+        self.subscription = None
+        self.start()
+
+    def start(self):
+        self.subscription = self.context.monitor(self.pvname, self.on_update, notify_disconnect=True)
+
+    def stop(self):
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+
+    def on_update(self, value):
+        if isinstance(value, Exception):
+            self.set_connected(False)
+            return
+
+        self.structure = value
+        self.value = unwrap(value)
+        self.set_connected(True)
+        for callback in list(self.callbacks.values()):
+            callback(pvname=self.pvname, value=self.value)
+
+    def set_connected(self, connected):
+        if connected == self.connected:
+            return
+
+        self.connected = connected
+        if connected:
+            self.connection_event.set()
+        else:
+            self.connection_event.clear()
+        for callback in list(self.connection_callbacks):
+            callback(pvname=self.pvname, conn=connected)
+
+    def wait_for_connection(self, timeout=None):
+        return self.connection_event.wait(timeout)
+
+    def add_callback(self, callback):
+        index = self.next_index
+        self.next_index += 1
+        self.callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index):
+        self.callbacks.pop(index, None)
+
+    def get(self, timeout=None):
+        # The monitor keeps the value current, so a read only has to wait for the first update
+        if not self.wait_for_connection(timeout):
+            return None
+        return self.value
+
+    def get_ctrlvars(self, timeout=None):
+        if not self.wait_for_connection(timeout):
+            return None
+        return {key: get_field(self.structure, path) for key, path in METADATA_FIELDS.items()}
+
+    def put(self, value, wait=False, use_complete=False, callback=None):
+        # p4p puts block, so they run on their own thread like a CA put with a completion callback
+        threading.Thread(target=self._put, args=(value, use_complete, callback), daemon=True).start()
+        return True
+
+    def _put(self, value, use_complete, callback):
+        try:
+            # A completion only comes once the move is done, however long it takes
+            self.context.put(self.pvname, value, timeout=None if use_complete else PUT_TIMEOUT, wait=use_complete)
+        except Exception as e:
+            print(f"{self.pvname}: put failed: {e}")
+            # Unlike pyepics, the failure of a put still reaches its callback, so the move is not left waiting
+            if callback is not None:
+                callback(pvname=self.pvname, error=e)
+            return
+
+        if callback is not None:
+            callback(pvname=self.pvname)
+
+    def disconnect(self):
+        self.stop()
+        self.set_connected(False)
+
+
+class PVAGroup(object):
+    """
+    A single monitor on a group PV, such as a QSRV group, feeding the channels of several
+    fields of one axis. Each field is a sub-structure of the group.
+    """
+
+    def __init__(self, context, name):
+        self.context = context
+        self.name = name
+        self.channels = {}
+        self.subscription = None
+
+    def attach(self, channel, field):
+        self.channels[field] = channel
+        if self.subscription is None:
+            self.subscription = self.context.monitor(self.name, self.on_update, notify_disconnect=True)
+
+    def detach(self, field):
+        self.channels.pop(field, None)
+        if not self.channels and self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+
+    def on_update(self, value):
+        for field, channel in list(self.channels.items()):
+            if isinstance(value, Exception):
+                channel.on_update(value)
+            elif value.changed(f"{field}.value"):
+                channel.on_update(value[field])
+
+
+class PVAGroupChannel(PVAChannel):
+    def __init__(self, context, pvname, group, field):
+        self.group = group
+        self.field = field
+        PVAChannel.__init__(self, context, pvname)
+
+    def start(self):
+        self.group.attach(self, self.field)
+
+    def stop(self):
+        self.group.detach(self.field)
+
+
+class PVABackend(object):
+    """pvAccess through p4p. Axes configured with a group get RBV, MOVN and LVIO from its monitor."""
+
+    def __init__(self):
+        if Context is None:
+            raise RuntimeError("The pvAccess backend needs p4p")
+        self.context = Context("pva", nt=False)
+        self.groups = {}
+
+    def add_group(self, axis, name, fields=None):
+        self.groups[axis] = (PVAGroup(self.context, name), fields or GROUP_FIELDS)
+
+    def create(self, pv_name):
+        axis, _, suffix = pv_name.partition(".")
+        group, fields = self.groups.get(axis, (None, {}))
+        if suffix in fields:
+            return PVAGroupChannel(self.context, pv_name, group, fields[suffix])
+        return PVAChannel(self.context, pv_name)
+
+    def get(self, pv_name, timeout):
+        value = self.context.get(pv_name, timeout=timeout, throw=False)
+        return None if isinstance(value, Exception) else unwrap(value)
+
+    def get_many(self, pv_names, timeout):
+        values = self.context.get(list(pv_names), timeout=timeout, throw=False)
+        return [None if isinstance(value, Exception) else unwrap(value) for value in values]
+
+
+BACKENDS = {"ca": CABackend, "pva": PVABackend}
+
+
+class BackendRegistry(object):
+    """
+    Selects the transport of every PV by its axis, the part of the name before the first
+    dot. Axes without an explicit backend, custom PVs included, use the default one.
+    """
+
+    def __init__(self, default=DEFAULT_BACKEND):
+        self.default = default
+        self.axes = {}
+        self.backends = {}
+
+    def configure(self, default=None):
+        if default is not None:
+            self.default = default
+
+    def get_backend(self, name):
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown backend {name}")
+        if name not in self.backends:
+            self.backends[name] = BACKENDS[name]()
+        return self.backends[name]
+
+    def set_backend(self, axis, name, group=None, group_fields=None):
+        backend = self.get_backend(name)
+        if group is not None:
+            if not isinstance(backend, PVABackend):
+                raise ValueError(f"{axis}: group PVs need the pva backend")
+            backend.add_group(axis, group, group_fields)
+        self.axes[axis] = backend
+
+    def unset_backend(self, axis):
+        self.axes.pop(axis, None)
+
+    def get_pv_backend(self, pv_name):
+        backend = self.axes.get(pv_name.split(".")[0])
+        return backend if backend is not None else self.get_backend(self.default)
+
+    def create(self, pv_name):
+        return self.get_pv_backend(pv_name).create(pv_name)
+
+    def get(self, pv_name, timeout):
+        return self.get_pv_backend(pv_name).get(pv_name, timeout)
+
+    def get_many(self, pv_names, timeout):
+        by_backend = {}
+        for pv_name in pv_names:
+            by_backend.setdefault(self.get_pv_backend(pv_name), []).append(pv_name)
+
+        values = {}
+        for backend, names in by_backend.items():
+            values.update(zip(names, backend.get_many(names, timeout)))
+        return [values[pv_name] for pv_name in pv_names]
+
+
+backends = BackendRegistry()
@@ -32,17 +32,27 @@ DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
 
 
 class BleTools(object):
+    # Resolved once and shared by the application and the advertisement
+    bus = None
+    adapter = None
+
     @classmethod
     def get_bus(self):
-        return dbus.SystemBus()
+        if self.bus is None:
+            self.bus = dbus.SystemBus()
+        return self.bus
 
     @classmethod
     def find_adapter(self, bus):
+        if self.adapter is not None:
+            return self.adapter
+
         remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"), DBUS_OM_IFACE)
         objects = remote_om.GetManagedObjects()
 
         for o, props in objects.items():
             if LE_ADVERTISING_MANAGER_IFACE in props:
+                self.adapter = o
                 return o
 
         return None
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from ble_motor_ctrl.backend import backends
+from ble_motor_ctrl.metrics import CA_GET_SECONDS
+
+MAX_AGE = 1.0
+EVICT_AGE = 60.0
+MAX_ENTRIES = 256
+FETCH_TIMEOUT = 1
+
+
+class CacheEntry(object):
+    def __init__(self, value, monitored=False):
+        self.value = value
+        self.timestamp = time.monotonic()
+        self.connected = value is not None
+        self.monitored = monitored
+
+    def get_age(self):
+        return time.monotonic() - self.timestamp
+
+
+class PVCache(object):
+    """
+    Process-wide cache of PV values, keyed by full PV/field name.
+    Entries fed by a CA monitor never go stale; the others are refreshed by the CA
+    workers once half of max_age has passed, and fetched again after max_age.
+    """
+
+    def __init__(self, max_age=MAX_AGE, evict_age=EVICT_AGE, max_entries=MAX_ENTRIES):
+        self.max_age = max_age
+        self.evict_age = evict_age
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_age=None, evict_age=None, max_entries=None):
+        if max_age is not None:
+            self.max_age = max_age
+        if evict_age is not None:
+            self.evict_age = evict_age
+        if max_entries is not None:
+            self.max_entries = max_entries
+
+    def lookup(self, pv_name):
+        with self.lock:
+            entry = self.entries.get(pv_name)
+            if entry is not None:
+                self.entries.move_to_end(pv_name)
+            fresh = entry is not None and entry.connected and (entry.monitored or entry.get_age() <= self.max_age)
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if not fresh:
+            return False, None
+
+        if not entry.monitored and entry.get_age() > self.max_age / 2:
+            self.refresh(pv_name)
+        return True, entry.value
+
+    def get(self, pv_name, timeout=FETCH_TIMEOUT):
+        hit, value = self.lookup(pv_name)
+        if hit:
+            return value
+        return self.fetch(pv_name, timeout)
+
+    def fetch(self, pv_name, timeout=FETCH_TIMEOUT):
+        with CA_GET_SECONDS.time(pv_name):
+            value = backends.get(pv_name, timeout)
+        self.update(pv_name, value)
+        return value
+
+    def refresh(self, pv_name):
+        with self.lock:
+            if pv_name in self.refreshing:
+                return
+            self.refreshing.add(pv_name)
+
+        # Imported here, as the workers read through this cache
+        from ble_motor_ctrl.worker import get_axis, workers
+
+        done = partial(self._on_refreshed, pv_name)
+        workers.submit(get_axis(pv_name), partial(self.fetch, pv_name), done, done)
+
+    def _on_refreshed(self, pv_name, *args):
+        with self.lock:
+            self.refreshing.discard(pv_name)
+
+    def update(self, pv_name, value, monitored=False):
+        with self.lock:
+            entry = self.entries.get(pv_name)
+            monitored = monitored or (entry is not None and entry.monitored)
+            self.entries[pv_name] = CacheEntry(value, monitored)
+            self.entries.move_to_end(pv_name)
+            self._evict()
+
+    def invalidate(self, pv_name):
+        with self.lock:
+            self.entries.pop(pv_name, None)
+
+    def unmonitor(self, pv_name):
+        with self.lock:
+            entry = self.entries.get(pv_name)
+            if entry is not None:
+                entry.monitored = False
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        expired = [
+            pv_name
+            for pv_name, entry in self.entries.items()
+            if not entry.monitored and entry.get_age() > self.evict_age
+        ]
+        for pv_name in expired:
+            del self.entries[pv_name]
+
+    def get_stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+pv_cache = PVCache()
@@ -0,0 +1,222 @@
+import time
+
+from ble_motor_ctrl.cache import pv_cache
+from ble_motor_ctrl.errors import FailedException
+from ble_motor_ctrl.metrics import CA_PUT_SECONDS, MOVE_SECONDS
+from ble_motor_ctrl.pool import pv_pool
+from ble_motor_ctrl.protocol import DISCARDED, DONE, FAILED, STOPPED, get_move_timeout
+from ble_motor_ctrl.worker import workers
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+FIELDS = ("VAL", "RLV", "STOP")
+
+
+class Move(object):
+    def __init__(self, callback, start, timer):
+        self.callback = callback
+        self.start = start
+        self.timer = timer
+        self.stopped = False
+
+
+class CommandQueue(object):
+    """
+    Motion commands of one axis. A move is put as soon as the put of the previous one has
+    been sent, without waiting for it to complete, so the motor record retargets a moving
+    axis instead of finishing the old move first. Writes received while a put is being sent
+    replace each other. Stops skip the queue and discard the pending move.
+
+    The callback of a move, if any, gets its outcome: DONE once its put completes, which the
+    motor record does when the move is done (DMOV 1), FAILED, DISCARDED if it was never
+    sent or a newer move retargeted the axis first, or STOPPED if a stop was written while
+    it ran. Done listeners are called with the outcome of every move that was not discarded.
+    A move still running past its expected duration is only counted as overdue: long moves
+    are legitimate, and its completion still decides the outcome.
+    """
+
+    def __init__(self, pv_name):
+        self.pv_name = pv_name
+        self.pvs = {}
+        self.pending = None
+        self.sending = False
+        # Moves whose put was sent and has not completed yet, by token
+        self.moves = {}
+        self.done_listeners = []
+        self.issued = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.overdue = 0
+
+    def get_pv(self, field):
+        if field not in self.pvs:
+            self.pvs[field] = pv_pool.acquire(f"{self.pv_name}.{field}")
+        return self.pvs[field]
+
+    def open(self):
+        # Created well before the first write, so a move or a stop never waits for the channel to connect
+        for field in FIELDS:
+            self.get_pv(field)
+
+    def check(self, field):
+        if not self.get_pv(field).connected:
+            raise FailedException(f"{self.pv_name}.{field} is not connected")
+
+    def add_done_listener(self, callback):
+        self.done_listeners.append(callback)
+
+    def move(self, field, value, callback=None):
+        self._discard()
+        self.pending = (field, value, callback)
+        self._pump()
+
+    def stop(self, value):
+        self._discard()
+        # Their puts still complete, once the motor has stopped, and report it as such
+        for move in self.moves.values():
+            move.stopped = True
+
+        pv = self.get_pv("STOP")
+        if pv.connected:
+            pv.put(value, wait=False)
+        else:
+            workers.submit(self.pv_name, lambda: self._put(pv, value), lambda: None, self._on_stop_failed)
+
+    def close(self):
+        # The axis is gone: nothing waits on its moves anymore and its channels go back to the pool
+        self._discard()
+        for token in list(self.moves):
+            self._finish(token, DISCARDED)
+        self.done_listeners = []
+        for field in self.pvs:
+            pv_pool.release(f"{self.pv_name}.{field}")
+        self.pvs = {}
+
+    def get_depth(self):
+        return (self.pending is not None) + len(self.moves)
+
+    def get_stats(self):
+        return {
+            "depth": self.get_depth(),
+            "issued": self.issued,
+            "coalesced": self.coalesced,
+            "completed": self.completed,
+            "failed": self.failed,
+            "overdue": self.overdue,
+        }
+
+    def _discard(self):
+        if self.pending is not None:
+            self.coalesced += 1
+            self._call(self.pending[2], DISCARDED)
+            self.pending = None
+
+    @staticmethod
+    def _call(callback, outcome):
+        if callback is not None:
+            callback(outcome)
+
+    def _pump(self):
+        if self.sending or self.pending is None:
+            return
+
+        field, value, callback = self.pending
+        self.pending = None
+        token = object()
+        self.issued += 1
+        for name in ("VAL", "RLV"):
+            pv_cache.invalidate(f"{self.pv_name}.{name}")
+
+        pv = self.get_pv(field)
+        start = time.monotonic()
+        _, position = pv_cache.lookup(f"{self.pv_name}.RBV")
+        timeout = get_move_timeout(self.pv_name, field, value, position)
+        # Registered before the put goes out, its completion may come back before the put returns
+        timer = GObject.timeout_add(int(timeout * 1000), self._on_timeout, token, timeout)
+        self.moves[token] = Move(callback, start, timer)
+        self.sending = True
+
+        def put():
+            self._put(pv, value, lambda error=None, **kwargs: self._on_put_done(token, pv.pvname, start, error))
+
+        if pv.connected:
+            # A put with a completion callback does not wait for it, so it is sent right away.
+            # Moves of several axes requested together then start together
+            try:
+                put()
+            except Exception as e:
+                print(f"{self.pv_name}: {e}")
+                self._on_send_failed(token, e)
+            else:
+                self._on_sent(token)
+        else:
+            workers.submit(self.pv_name, put, lambda: self._on_sent(token), lambda e: self._on_send_failed(token, e))
+
+    def _put(self, pv, value, callback=None):
+        if pv.put(value, wait=False, use_complete=callback is not None, callback=callback) is None:
+            raise FailedException(f"Timed out writing {pv.pvname}")
+
+    def _on_sent(self, token):
+        # The record now heads for the new target, so the moves it replaced will never reach theirs
+        for other in [other for other in self.moves if other is not token]:
+            if self._finish(other, DISCARDED):
+                self.coalesced += 1
+        self.sending = False
+        self._pump()
+
+    def _on_send_failed(self, token, error):
+        if self._finish(token, FAILED):
+            self.failed += 1
+        self.sending = False
+        self._pump()
+
+    def _finish(self, token, outcome):
+        move = self.moves.pop(token, None)
+        if move is None:
+            return False
+
+        if move.timer is not None:
+            GObject.source_remove(move.timer)
+        if outcome == DONE:
+            MOVE_SECONDS.observe(time.monotonic() - move.start, self.pv_name)
+        self._call(move.callback, outcome)
+        if outcome != DISCARDED:
+            for listener in self.done_listeners:
+                listener(outcome)
+        return True
+
+    def _on_put_done(self, token, pv_name, start, error=None):
+        # Called from the thread of the PV backend, with the error of a pvAccess put that failed
+        if error is not None:
+            GObject.idle_add(self._on_put_failed, token)
+            return
+
+        CA_PUT_SECONDS.observe(time.monotonic() - start, pv_name)
+        GObject.idle_add(self._on_complete, token)
+
+    def _on_complete(self, token):
+        move = self.moves.get(token)
+        if move is not None and self._finish(token, STOPPED if move.stopped else DONE):
+            self.completed += 1
+        return False
+
+    def _on_put_failed(self, token):
+        if self._finish(token, FAILED):
+            self.failed += 1
+        return False
+
+    def _on_timeout(self, token, timeout):
+        move = self.moves.get(token)
+        if move is not None:
+            move.timer = None
+            self.overdue += 1
+            print(f"{self.pv_name}: move still running after {timeout:.1f} s")
+        return False
+
+    def _on_stop_failed(self, error):
+        self.failed += 1
+        print(f"{self.pv_name}: stop failed: {error}")
@@ -0,0 +1,138 @@
+import struct
+
+from ble_motor_ctrl.errors import FailedException, InvalidValueLengthException
+
+ASCII = "ascii"
+FLOAT64 = "float64"
+INT32 = "int32"
+
+FLOAT64_STRUCT = struct.Struct("<d")
+INT32_STRUCT = struct.Struct("<i")
+INT32_MIN = -(2**31)
+INT32_MAX = 2**31 - 1
+PRESENTATION_FORMAT_STRUCT = struct.Struct("<BbHBH")
+AXES_HEADER_STRUCT = struct.Struct("<HB")
+AXIS_STATUS_STRUCT = struct.Struct("<ddBB")
+MOVE_TARGET_STRUCT = struct.Struct("<Bd")
+MOVE_RESULT_STRUCT = struct.Struct("<HB")
+MOVE_DONE_STRUCT = struct.Struct("<dBB")
+UNKNOWN_FLAG = 0xFF
+
+# Characteristic Presentation Format (0x2904) format types
+GATT_FORMATS = {ASCII: 0x19, FLOAT64: 0x15, INT32: 0x10}
+UNITLESS = 0x2700
+BT_SIG_NAMESPACE = 0x01
+DIGITS = 5
+# Largest int32 exponent that still leaves a unit of range
+MAX_DIGITS = 9
+
+
+def check_format(fmt):
+    if fmt not in GATT_FORMATS:
+        raise ValueError(f"Unknown payload format {fmt}, expected one of {', '.join(GATT_FORMATS)}")
+    return fmt
+
+
+def check_digits(digits):
+    if not isinstance(digits, int) or not 0 <= digits <= MAX_DIGITS:
+        raise ValueError(f"Invalid int32 decimals {digits}, expected an integer from 0 to {MAX_DIGITS}")
+    return digits
+
+
+def encode_string(text):
+    return text.encode()
+
+
+def encode_number(value, fmt=ASCII, digits=DIGITS):
+    if fmt == FLOAT64:
+        return FLOAT64_STRUCT.pack(value)
+    if fmt == INT32:
+        # Fixed point, the exponent is advertised in the presentation format descriptor
+        number = int(round(value * 10**digits))
+        if not INT32_MIN <= number <= INT32_MAX:
+            raise FailedException(f"{value} is out of the int32 range at {digits} decimals")
+        return INT32_STRUCT.pack(number)
+    return encode_string(str(round(value, digits)))
+
+
+def encode_flag(value, fmt=ASCII):
+    if fmt == ASCII:
+        return FLAG_TRUE if float(value) else FLAG_FALSE
+    return encode_number(1 if float(value) else 0, fmt, 0)
+
+
+def decode_string(value):
+    # One character per byte, as dbus-python renders the bytes of a written value
+    return bytes(value).decode("latin-1")
+
+
+def decode_number(value, fmt=ASCII, digits=DIGITS):
+    if fmt == ASCII:
+        return decode_string(value)
+
+    packer = FLOAT64_STRUCT if fmt == FLOAT64 else INT32_STRUCT
+    if len(value) != packer.size:
+        raise InvalidValueLengthException(f"{fmt} values are {packer.size} bytes long")
+
+    number = packer.unpack(bytes(value))[0]
+    return number if fmt == FLOAT64 else number / 10**digits
+
+
+def encode_flag_byte(value):
+    if value is None:
+        return UNKNOWN_FLAG
+    return 1 if float(value) else 0
+
+
+def encode_axes_frame(seq, changed, axes):
+    """
+    Sequence number (uint16), axis count (uint8), changed-axis bitmask (one bit per axis,
+    LSB first) and then RBV, VAL (float64), MOVN and LVIO (uint8, 0xFF if unknown) per axis.
+    """
+    frame = bytearray(AXES_HEADER_STRUCT.pack(seq & 0xFFFF, len(axes)))
+    frame += changed.to_bytes((len(axes) + 7) // 8, "little")
+    for rbv, val, movn, lvio in axes:
+        frame += AXIS_STATUS_STRUCT.pack(
+            float("nan") if rbv is None else rbv,
+            float("nan") if val is None else val,
+            encode_flag_byte(movn),
+            encode_flag_byte(lvio),
+        )
+    return bytes(frame)
+
+
+def get_axes_frame_capacity(limit, count):
+    """Number of the first count axes whose frame fits in limit bytes, all of them without a limit."""
+    if limit is None:
+        return count
+    for fits in range(count, 0, -1):
+        if AXES_HEADER_STRUCT.size + (fits + 7) // 8 + fits * AXIS_STATUS_STRUCT.size <= limit:
+            return fits
+    return 0
+
+
+def decode_move_frame(value):
+    """(axis slot, target) pairs of a group move: uint8 slot and float64 target each, little-endian."""
+    if not value or len(value) % MOVE_TARGET_STRUCT.size:
+        raise InvalidValueLengthException(f"Group moves are one or more {MOVE_TARGET_STRUCT.size} byte targets")
+    return list(MOVE_TARGET_STRUCT.iter_unpack(bytes(value)))
+
+
+def encode_move_result(seq, outcome):
+    return MOVE_RESULT_STRUCT.pack(seq & 0xFFFF, outcome)
+
+
+def encode_move_done(rbv, lvio, outcome):
+    """Final RBV (float64, NaN if unknown), LVIO (uint8, 0xFF if unknown) and outcome (uint8)."""
+    return MOVE_DONE_STRUCT.pack(float("nan") if rbv is None else rbv, encode_flag_byte(lvio), outcome)
+
+
+def encode_presentation_format(fmt, digits=DIGITS):
+    exponent = -digits if fmt == INT32 else 0
+    return PRESENTATION_FORMAT_STRUCT.pack(GATT_FORMATS[fmt], exponent, UNITLESS, BT_SIG_NAMESPACE, 0)
+
+
+FLAG_TRUE = encode_string("1")
+FLAG_FALSE = encode_string("0")
+INVALID = encode_string("Invalid")
+NO_PV = encode_string("No PV")
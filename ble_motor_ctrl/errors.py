@@ -0,0 +1,31 @@
+class GattException(Exception):
+    """
+    An error reply to a GATT request. Both runtimes reply with the D-Bus error named by
+    _dbus_error_name, dbus-python on its own and the asyncio runtime through as_dbus_error.
+    """
+
+    _dbus_error_name = "org.bluez.Error.Failed"
+
+
+class InvalidArgsException(GattException):
+    _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
+
+
+class NotSupportedException(GattException):
+    _dbus_error_name = "org.bluez.Error.NotSupported"
+
+
+class NotPermittedException(GattException):
+    _dbus_error_name = "org.bluez.Error.NotPermitted"
+
+
+class FailedException(GattException):
+    _dbus_error_name = "org.bluez.Error.Failed"
+
+
+class InvalidValueLengthException(GattException):
+    _dbus_error_name = "org.bluez.Error.InvalidValueLength"
+
+
+class InvalidOffsetException(GattException):
+    _dbus_error_name = "org.bluez.Error.InvalidOffset"
@@ -0,0 +1,116 @@
+import math
+import struct
+import time
+import zlib
+from array import array
+
+from ble_motor_ctrl.encoding import DIGITS
+
+HISTORY_SIZE = 1024
+# Digits (uint8), sample count (uint32), first timestamp in ms (int64), first value in fixed point (int64)
+HISTORY_HEADER_STRUCT = struct.Struct("<BIqq")
+# Chunk index and chunk count (uint16)
+CHUNK_HEADER_STRUCT = struct.Struct("<HH")
+
+
+class PositionHistory(object):
+    """
+    The last size (timestamp, RBV) samples of one axis, kept in two preallocated float64
+    arrays used as a ring buffer, so an axis never takes more than 16 bytes per sample.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.times = array("d", bytes(8 * size))
+        self.values = array("d", bytes(8 * size))
+        self.next = 0
+        self.count = 0
+
+    def append(self, value, timestamp=None):
+        if value is None or not math.isfinite(float(value)):
+            return
+
+        self.times[self.next] = time.time() if timestamp is None else timestamp
+        self.values[self.next] = float(value)
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def get_window(self, start, end):
+        first = self.next - self.count
+        samples = []
+        for index in range(first, self.next):
+            timestamp = self.times[index % self.size]
+            if start <= timestamp <= end:
+                samples.append((timestamp, self.values[index % self.size]))
+        return samples
+
+    def get_memory(self):
+        return self.times.itemsize * len(self.times) + self.values.itemsize * len(self.values)
+
+
+class HistoryStore(object):
+    """The position history of every axis. A size of 0 disables it."""
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.histories = {}
+
+    def configure(self, size=None):
+        if size is not None:
+            self.size = size
+
+    def create(self, pv_name):
+        self.histories[pv_name] = PositionHistory(self.size)
+        return self.histories[pv_name]
+
+    def remove(self, pv_name):
+        self.histories.pop(pv_name, None)
+
+    def get_stats(self):
+        return {
+            "axes": len(self.histories),
+            "samples": sum(history.count for history in self.histories.values()),
+            "bytes": sum(history.get_memory() for history in self.histories.values()),
+        }
+
+
+def write_varint(out, number):
+    # Zigzag first, so small negative deltas stay small
+    number = (number << 1) ^ (number >> 63)
+    while number >= 0x80:
+        out.append((number & 0x7F) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def encode_samples(samples, digits=DIGITS):
+    """
+    A header with the first sample, timestamps in ms and values in fixed point with digits
+    decimals, followed by the difference of every other sample to the previous one as two
+    zigzag varints: time, then value.
+    """
+    points = [(int(round(timestamp * 1000)), int(round(value * 10**digits))) for timestamp, value in samples]
+    if not points:
+        return HISTORY_HEADER_STRUCT.pack(digits, 0, 0, 0)
+
+    payload = bytearray(HISTORY_HEADER_STRUCT.pack(digits, len(points), *points[0]))
+    for (last_time, last_value), (timestamp, value) in zip(points, points[1:]):
+        write_varint(payload, timestamp - last_time)
+        write_varint(payload, value - last_value)
+    return bytes(payload)
+
+
+def split_chunks(payload, size, compress=False):
+    """Chunks of at most size bytes, each one with its index and the chunk count."""
+    if compress:
+        payload = zlib.compress(payload)
+    room = size - CHUNK_HEADER_STRUCT.size
+    pieces = [payload[start : start + room] for start in range(0, len(payload), room)] or [b""]
+    return [CHUNK_HEADER_STRUCT.pack(index, len(pieces)) + piece for index, piece in enumerate(pieces)]
+
+
+def encode_history_end(count):
+    return CHUNK_HEADER_STRUCT.pack(count, count)
+
+
+histories = HistoryStore()
@@ -0,0 +1,95 @@
+import time
+
+from ble_motor_ctrl.encoding import DIGITS, encode_string
+
+FIELDS = ("DESC", "EGU", "PREC", "HLM", "LLM", "VELO", "ACCL")
+TTL = 600
+
+
+class AxisMetadata(object):
+    """The slow-changing fields of one axis, strings already encoded for the GATT replies."""
+
+    def __init__(self, desc=None, egu=None, prec=None, hlm=None, llm=None, velo=None, accl=None):
+        self.desc = None if desc is None else encode_string(str(desc))
+        self.egu = None if egu is None else encode_string(str(egu))
+        self.digits = DIGITS if prec is None else int(prec)
+        self.high_limit = hlm
+        self.low_limit = llm
+        self.velocity = velo
+        self.acceleration = accl or 0.0
+        self.timestamp = time.monotonic()
+
+    def get_move_time(self, distance):
+        # Travel at VELO plus the ramps up and down, None while the speed is unknown
+        if not self.velocity or self.velocity <= 0:
+            return None
+        return abs(distance) / self.velocity + 2 * self.acceleration
+
+    def check_limits(self, value):
+        # The motor record disables its soft limits when both are 0
+        if self.high_limit is None or self.low_limit is None or self.high_limit == self.low_limit == 0:
+            return True
+        return self.low_limit <= value <= self.high_limit
+
+
+def get_pv_names(pvs):
+    return [f"{pv}.{field}" for pv in pvs for field in FIELDS]
+
+
+def get_axes(pvs, values):
+    """The metadata of every axis of pvs with any field read, from the values of get_pv_names(pvs)."""
+    axes = {}
+    for index, pv in enumerate(pvs):
+        fields = values[index * len(FIELDS) : (index + 1) * len(FIELDS)]
+        if any(value is not None for value in fields):
+            axes[pv] = AxisMetadata(*fields)
+    return axes
+
+
+class MetadataStore(object):
+    """
+    DESC, EGU, PREC, the soft limits, VELO and ACCL of the axes. Each runtime reads them for
+    all of its axes in one batched request off its main loop, again every ttl seconds, and
+    as soon as an axis that could not be read connects. Lookups are memory only; axes whose
+    fields could not be read have no entry until a later load succeeds.
+    """
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self.pvs = []
+        self.axes = {}
+        self.loads = 0
+
+    def configure(self, ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+
+    def add(self, pvs):
+        """Tracks the axes of pvs, returns the ones that were not tracked yet, to be loaded."""
+        pvs = [pv for pv in pvs if pv not in self.pvs]
+        self.pvs.extend(pvs)
+        return pvs
+
+    def remove(self, pv):
+        if pv in self.pvs:
+            self.pvs.remove(pv)
+        self.axes.pop(pv, None)
+
+    def get(self, pv):
+        return self.axes.get(pv)
+
+    def is_missing(self, pv):
+        return pv in self.pvs and pv not in self.axes
+
+    def store(self, axes):
+        self.loads += 1
+        for pv, metadata in axes.items():
+            # An axis removed while its fields were being read stays removed
+            if pv in self.pvs:
+                self.axes[pv] = metadata
+
+    def get_stats(self):
+        return {"axes": len(self.axes), "pending": len(self.pvs) - len(self.axes), "loads": self.loads}
+
+
+metadata = MetadataStore()
@@ -0,0 +1,250 @@
+import bisect
+import functools
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MOVE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0)
+LAG_PROBE_PERIOD = 100
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+    def get_total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels] = (counts, total + value)
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def get_mean(self):
+        with self.lock:
+            count = sum(sum(counts) for counts, _ in self.values.values())
+            total = sum(total for _, total in self.values.values())
+        return total / count if count else 0.0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_labels = format_labels(self.labels + ("le",), labels + (le,))
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start, *self.labels)
+
+
+class Registry(object):
+    """
+    Metrics of the application. Besides its own counters and histograms, it exports the
+    get_stats dictionaries of the other components as gauges, read each time it renders.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.stats = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_stats(self, prefix, get_stats, label=None):
+        # With a label, get_stats returns a dictionary of stats per label value
+        self.stats.append((prefix, get_stats, label))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        for prefix, get_stats, label in self.stats:
+            stats = get_stats()
+            samples = {}
+            for label_value, values in stats.items() if label else [(None, stats)]:
+                for key, value in values.items():
+                    labels = format_labels((label,), (label_value,)) if label else ""
+                    samples.setdefault(f"ble_motor_{prefix}_{key}", []).append(f"{labels} {value}")
+            for name, values in samples.items():
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(name + value for value in values)
+
+        return "\n".join(lines) + "\n"
+
+    def summarize(self):
+        lines = [
+            f"mainloop_lag_ms={MAINLOOP_LAG.get_mean() * 1000:.1f}",
+            f"ca_get_ms={CA_GET_SECONDS.get_mean() * 1000:.1f}",
+            f"ca_put_ms={CA_PUT_SECONDS.get_mean() * 1000:.1f}",
+            f"move_ms={MOVE_SECONDS.get_mean() * 1000:.1f}",
+            f"gatt_ms={SERVICE_SECONDS.get_mean() * 1000:.1f}",
+            f"gatt_errors={GATT_ERRORS.get_total()}",
+            f"notify_sent={NOTIFICATIONS.get_total()}",
+            f"notify_suppressed={SUPPRESSED.get_total()}",
+            f"notify_truncated={TRUNCATED.get_total()}",
+            f"stalls={STALLS.get_total()}",
+        ]
+        for prefix, get_stats, label in self.stats:
+            if label is None:
+                lines.extend(f"{prefix}_{key}={value}" for key, value in get_stats().items())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+CA_GET_SECONDS = registry.histogram("ble_motor_ca_get_seconds", "PV read latency", ("pv",))
+CA_PUT_SECONDS = registry.histogram("ble_motor_ca_put_seconds", "PV put latency, until the put completes", ("pv",))
+MOVE_SECONDS = registry.histogram(
+    "ble_motor_move_seconds",
+    "Move duration, from its put to the motor record reporting it done",
+    ("pv",),
+    MOVE_BUCKETS,
+)
+SERVICE_SECONDS = registry.histogram(
+    "ble_motor_gatt_service_seconds", "GATT request service time", ("characteristic", "method")
+)
+GATT_ERRORS = registry.counter(
+    "ble_motor_gatt_errors_total", "GATT requests answered with an error", ("characteristic", "method")
+)
+NOTIFICATIONS = registry.counter("ble_motor_notifications_total", "Notifications sent", ("characteristic",))
+SUPPRESSED = registry.counter(
+    "ble_motor_notifications_suppressed_total", "Notifications suppressed by the notify policy", ("pv",)
+)
+TRUNCATED = registry.counter(
+    "ble_motor_notifications_truncated_total", "Notifications cut to the smallest client MTU", ("characteristic",)
+)
+MAINLOOP_LAG = registry.histogram("ble_motor_mainloop_lag_seconds", "GLib main loop dispatch lag")
+STALLS = registry.counter("ble_motor_mainloop_stalls_total", "Main loop stalls caught by the watchdog")
+
+
+def timed(method):
+    """Records the service time of an asynchronous ReadValue/WriteValue handler."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, reply_handler, error_handler):
+        labels = (type(self).__name__, method.__name__)
+        start = time.monotonic()
+
+        def reply(*result):
+            SERVICE_SECONDS.observe(time.monotonic() - start, *labels)
+            reply_handler(*result)
+
+        def error(e):
+            SERVICE_SECONDS.observe(time.monotonic() - start, *labels)
+            GATT_ERRORS.inc(*labels)
+            error_handler(e)
+
+        try:
+            return method(self, *args, reply_handler=reply, error_handler=error)
+        except Exception:
+            GATT_ERRORS.inc(*labels)
+            raise
+
+    return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsStreamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(registry.render().encode())
+
+
+def serve(http_port=None, bind="127.0.0.1", socket_path=None):
+    servers = []
+    if http_port:
+        servers.append(ThreadingHTTPServer((bind, http_port), MetricsHandler))
+        print(f"Metrics available at http://{bind}:{http_port}/metrics")
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        servers.append(socketserver.UnixStreamServer(socket_path, MetricsStreamHandler))
+        print(f"Metrics available on {socket_path}")
+
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return servers
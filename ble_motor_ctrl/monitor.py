@@ -0,0 +1,226 @@
+import threading
+import time
+from functools import partial
+
+from ble_motor_ctrl.backend import backends
+from ble_motor_ctrl.cache import pv_cache
+from ble_motor_ctrl.metrics import CA_GET_SECONDS
+from ble_motor_ctrl.pool import pv_pool
+from ble_motor_ctrl.worker import workers
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+POLL_PERIOD = 2000
+SCHEDULER_TICK = 100
+BATCH_TIMEOUT = 1
+
+
+class MonitorEngine(object):
+    """
+    Keeps one monitor per PV and dispatches its updates from the GLib main loop.
+    Updates arriving before the loop runs are collapsed; None means disconnected.
+    """
+
+    def __init__(self):
+        self.pvs = {}
+        self.callbacks = {}
+        self.values = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.dispatch_scheduled = False
+
+    def subscribe(self, pv_name, callback):
+        callbacks = self.callbacks.setdefault(pv_name, [])
+        if callback not in callbacks:
+            callbacks.append(callback)
+
+        if pv_name not in self.pvs:
+            pv = pv_pool.acquire(pv_name)
+            index = pv.add_callback(partial(self._on_change, pv_name))
+            on_connection = partial(self._on_connection, pv_name)
+            pv.connection_callbacks.append(on_connection)
+            self.pvs[pv_name] = (pv, index, on_connection)
+            if pv.connected:
+                # The channel may already be open for someone else, so no connection event will come
+                self._schedule(pv_name, pv.value)
+        elif self.values.get(pv_name) is not None:
+            callback(self.values[pv_name])
+
+    def unsubscribe(self, pv_name, callback):
+        callbacks = self.callbacks.get(pv_name, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+        if not callbacks and pv_name in self.pvs:
+            pv, index, on_connection = self.pvs.pop(pv_name)
+            pv.remove_callback(index)
+            if on_connection in pv.connection_callbacks:
+                pv.connection_callbacks.remove(on_connection)
+            pv_pool.release(pv_name)
+            self.callbacks.pop(pv_name, None)
+            self.values.pop(pv_name, None)
+            pv_cache.unmonitor(pv_name)
+
+    def get_value(self, pv_name):
+        return self.values.get(pv_name)
+
+    def set_period(self, pv_name, callback, period):
+        # Monitors push every update, there is no sampling period to adapt
+        pass
+
+    def _on_change(self, pv_name, value=None, **kwargs):
+        self._schedule(pv_name, value)
+
+    def _on_connection(self, pv_name, conn=False, **kwargs):
+        if not conn:
+            self._schedule(pv_name, None)
+
+    def _schedule(self, pv_name, value):
+        with self.lock:
+            self.pending[pv_name] = value
+            if self.dispatch_scheduled:
+                return
+            self.dispatch_scheduled = True
+        GObject.idle_add(self._dispatch)
+
+    def _dispatch(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.dispatch_scheduled = False
+
+        for pv_name, value in pending.items():
+            if pv_name not in self.pvs:
+                continue
+            self.values[pv_name] = value
+            pv_cache.update(pv_name, value, monitored=True)
+            for callback in list(self.callbacks.get(pv_name, [])):
+                # One failing subscriber must not starve the others or drop the rest of the batch
+                try:
+                    callback(value)
+                except Exception as e:
+                    print(f"{pv_name}: monitor callback failed: {e}")
+
+        return False
+
+
+class Subscription(object):
+    def __init__(self, pv_names, callback, period):
+        self.pv_names = pv_names
+        self.callback = callback
+        self.period = period
+        self.next_due = 0.0
+
+
+class NotifyScheduler(object):
+    """
+    Owns every periodic subscription and drives them all from a single GLib timer.
+    The PVs of all subscriptions due on a tick are read in one batch per backend,
+    off the main loop, and the results are fanned out to their callbacks.
+    """
+
+    def __init__(self, tick=SCHEDULER_TICK):
+        self.tick = tick
+        self.subscriptions = {}
+        self.timer = None
+        self.busy = False
+
+    def subscribe(self, key, pv_names, callback, period):
+        # A key only ever holds one subscription, so restarting it never leaves a stale schedule behind
+        self.subscriptions[key] = Subscription(list(pv_names), callback, period)
+        if self.timer is None:
+            self.timer = GObject.timeout_add(self.tick, self._on_tick)
+
+    def unsubscribe(self, key):
+        self.subscriptions.pop(key, None)
+
+    def set_period(self, key, period):
+        subscription = self.subscriptions.get(key)
+        if subscription is not None and subscription.period != period:
+            subscription.period = period
+            subscription.next_due = min(subscription.next_due, time.monotonic() + period / 1000)
+
+    def _on_tick(self):
+        if not self.subscriptions:
+            self.timer = None
+            return False
+
+        if self.busy:
+            return True
+
+        now = time.monotonic()
+        due = {key: sub for key, sub in self.subscriptions.items() if sub.next_due <= now}
+        if not due:
+            return True
+
+        for sub in due.values():
+            sub.next_due = now + sub.period / 1000
+
+        pv_names = sorted({pv_name for sub in due.values() for pv_name in sub.pv_names})
+        if not pv_names:
+            self._fan_out(due, {})
+            return True
+
+        self.busy = True
+        # A failed or rejected batch still fans out, as disconnected values, so the next tick can run
+        workers.submit(
+            "scheduler",
+            partial(self._read_batch, pv_names),
+            lambda values: self._fan_out(due, values),
+            lambda e: self._fan_out(due, {}),
+        )
+        return True
+
+    def _read_batch(self, pv_names):
+        start = time.monotonic()
+        values = dict(zip(pv_names, backends.get_many(pv_names, BATCH_TIMEOUT)))
+        elapsed = time.monotonic() - start
+        for pv_name, value in values.items():
+            CA_GET_SECONDS.observe(elapsed, pv_name)
+            pv_cache.update(pv_name, value)
+        return values
+
+    def _fan_out(self, due, values):
+        self.busy = False
+        for key, sub in due.items():
+            if self.subscriptions.get(key) is not sub:
+                continue
+            if sub.callback({pv_name: values.get(pv_name) for pv_name in sub.pv_names}) is False:
+                self.unsubscribe(key)
+
+        return False
+
+
+scheduler = NotifyScheduler()
+
+
+class PollEngine(object):
+    """
+    Same interface as MonitorEngine, for IOCs or gateways where monitors are not wanted.
+    PVs are read periodically through the shared notification scheduler.
+    """
+
+    def __init__(self, period=POLL_PERIOD):
+        self.period = period
+
+    def configure(self, period=None):
+        if period is not None:
+            self.period = period
+
+    def subscribe(self, pv_name, callback):
+        scheduler.subscribe((pv_name, callback), [pv_name], partial(self._on_poll, pv_name, callback), self.period)
+
+    def unsubscribe(self, pv_name, callback):
+        scheduler.unsubscribe((pv_name, callback))
+
+    def set_period(self, pv_name, callback, period):
+        scheduler.set_period((pv_name, callback), period or self.period)
+
+    def _on_poll(self, pv_name, callback, values):
+        callback(values[pv_name])
+
+
+monitors = MonitorEngine()
+pollers = PollEngine()
@@ -0,0 +1,106 @@
+import time
+
+from ble_motor_ctrl.metrics import SUPPRESSED
+
+
+class NotifyPolicy(object):
+    """
+    Per-axis notification policy. Values within the deadband of the last notified one are
+    suppressed, like the motor record MDEL field, and notifications are limited to max_rate
+    per second. While polling, the axis is sampled every moving_period ms while MOVN is 1
+    and every idle_period ms otherwise.
+    """
+
+    def __init__(self, deadband=0.0, relative_deadband=0.0, max_rate=0, moving_period=None, idle_period=None):
+        self.deadband = deadband
+        self.relative_deadband = relative_deadband
+        self.max_rate = max_rate
+        self.moving_period = moving_period
+        self.idle_period = idle_period
+
+    def is_adaptive(self):
+        return self.moving_period is not None or self.idle_period is not None
+
+    def get_period(self, moving):
+        return self.moving_period if moving else self.idle_period
+
+    def in_deadband(self, value, last_value):
+        if last_value is None:
+            return False
+        return abs(value - last_value) <= max(self.deadband, self.relative_deadband * abs(last_value))
+
+
+class PolicyGate(object):
+    """
+    Applies a NotifyPolicy to one stream of values. A value held back by the rate limit is
+    sent once the limit allows it, unless a newer one replaces it first. Each runtime
+    provides the timers of its main loop.
+    """
+
+    def __init__(self, policy, send, name=""):
+        self.policy = policy
+        self.send = send
+        self.name = name
+        self.last_value = None
+        self.last_sent = 0.0
+        self.pending = None
+        self.timer = None
+        self.sent = 0
+        self.suppressed = 0
+
+    def reset(self):
+        self.last_value = None
+        self.pending = None
+        if self.timer is not None:
+            self.cancel_timer(self.timer)
+            self.timer = None
+
+    def update(self, value):
+        if self.pending is not None:
+            # Superseded before the rate limit let it through
+            self.pending = None
+            self._suppress()
+
+        if self.policy.in_deadband(value, self.last_value):
+            self._suppress()
+            return
+
+        if self.policy.max_rate:
+            wait = self.last_sent + 1 / self.policy.max_rate - time.monotonic()
+            if wait > 0:
+                self.pending = value
+                if self.timer is None:
+                    self.timer = self.start_timer(wait, self._flush)
+                return
+
+        self._send(value)
+
+    def start_timer(self, delay, callback):
+        raise NotImplementedError
+
+    def cancel_timer(self, timer):
+        raise NotImplementedError
+
+    def _flush(self):
+        self.timer = None
+        value, self.pending = self.pending, None
+        if value is not None:
+            self._send(value)
+        return False
+
+    def _send(self, value):
+        # send returns False when the value would not change what clients already have
+        if self.send(value) is False:
+            self._suppress()
+            return
+
+        self.last_value = value
+        self.last_sent = time.monotonic()
+        self.sent += 1
+
+    def _suppress(self):
+        self.suppressed += 1
+        SUPPRESSED.inc(self.name)
+
+    def get_stats(self):
+        return {"sent": self.sent, "suppressed": self.suppressed}
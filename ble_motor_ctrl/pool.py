@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+
+from ble_motor_ctrl.backend import backends
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+POOL_SIZE = 32
+IDLE_TIMEOUT = 300
+SWEEP_PERIOD = 30
+CONNECTION_TIMEOUT = 1.0
+METADATA_FIELDS = {
+    "units": "egu",
+    "precision": "prec",
+    "lower_ctrl_limit": "llm",
+    "upper_ctrl_limit": "hlm",
+}
+
+
+class PoolEntry(object):
+    def __init__(self, pv):
+        self.pv = pv
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.metadata = None
+
+
+class PVPool(object):
+    """
+    Owns the PV channels of the application, together with their control metadata.
+    PVs in use are kept; at most size idle ones are kept, least recently used first out,
+    and idle ones are disconnected after idle_timeout seconds.
+    """
+
+    def __init__(self, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.timer = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def configure(self, size=None, idle_timeout=None):
+        if size is not None:
+            self.size = size
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+
+    def _get_entry(self, pv_name):
+        with self.lock:
+            entry = self.entries.get(pv_name)
+            if entry is None:
+                self.misses += 1
+                entry = PoolEntry(backends.create(pv_name))
+                self.entries[pv_name] = entry
+            else:
+                self.hits += 1
+            self.entries.move_to_end(pv_name)
+            entry.last_used = time.monotonic()
+
+            if self.timer is None:
+                self.timer = GObject.timeout_add_seconds(SWEEP_PERIOD, self._sweep)
+            self._trim()
+            return entry
+
+    def get(self, pv_name):
+        return self._get_entry(pv_name).pv
+
+    def acquire(self, pv_name):
+        with self.lock:
+            entry = self._get_entry(pv_name)
+            entry.refs += 1
+            return entry.pv
+
+    def release(self, pv_name):
+        with self.lock:
+            entry = self.entries.get(pv_name)
+            if entry is None:
+                return
+            entry.refs = max(0, entry.refs - 1)
+            entry.last_used = time.monotonic()
+            self._trim()
+
+    def connect(self, pv_name, timeout=CONNECTION_TIMEOUT):
+        pv = self.get(pv_name)
+        if pv.connected or pv.wait_for_connection(timeout=timeout):
+            return pv
+        return None
+
+    def peek_metadata(self, pv_name):
+        with self.lock:
+            entry = self.entries.get(pv_name)
+            if entry is None or not entry.pv.connected:
+                return None
+            return entry.metadata
+
+    def get_metadata(self, pv_name, timeout=CONNECTION_TIMEOUT):
+        entry = self._get_entry(pv_name)
+        if entry.metadata is None:
+            if not entry.pv.wait_for_connection(timeout=timeout):
+                return None
+            ctrlvars = entry.pv.get_ctrlvars(timeout=timeout) or {}
+            entry.metadata = {key: ctrlvars.get(field) for field, key in METADATA_FIELDS.items()}
+        return entry.metadata
+
+    def _trim(self):
+        idle = [pv_name for pv_name, entry in self.entries.items() if entry.refs == 0]
+        for pv_name in idle[: max(0, len(idle) - self.size)]:
+            self._evict(pv_name)
+
+    def _sweep(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [
+                pv_name
+                for pv_name, entry in self.entries.items()
+                if entry.refs == 0 and now - entry.last_used > self.idle_timeout
+            ]
+            for pv_name in expired:
+                self._evict(pv_name)
+        return True
+
+    def _evict(self, pv_name):
+        entry = self.entries.pop(pv_name)
+        self.evicted += 1
+        entry.pv.disconnect()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "in_use": sum(1 for entry in self.entries.values() if entry.refs),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+            }
+
+
+pv_pool = PVPool()
@@ -0,0 +1,429 @@
+"""
+The part of the GATT application both runtimes share: UUIDs, move outcomes, and the
+encoding, validation, group move and history logic behind the characteristics. Nothing
+here touches D-Bus or a main loop; application.py (dbus-python and GLib) and aio.py
+(dbus-next and asyncio) wrap it in their own GATT objects.
+"""
+
+import math
+import struct
+import time
+from functools import partial
+
+from ble_motor_ctrl.encoding import ASCII, DIGITS, encode_axes_frame, encode_flag, encode_number, encode_string
+from ble_motor_ctrl.encoding import get_axes_frame_capacity
+from ble_motor_ctrl.errors import FailedException, InvalidOffsetException, InvalidValueLengthException
+from ble_motor_ctrl.history import encode_history_end, encode_samples, split_chunks
+from ble_motor_ctrl.metadata import metadata
+from ble_motor_ctrl.metrics import TRUNCATED, registry
+from ble_motor_ctrl.sessions import sessions
+
+MOTOR_SVC_UUID = "84e7f883-7c80-4b64-88a5-6077ce2e8925"
+UUID_SUFFIX = "4a5b-8d75-3e5b444bc3cf"
+POSITION_UUID_GROUP = "710e"
+MOVN_UUID_GROUP = "710f"
+RBPV_UUID_GROUP = "7110"
+AXES_UUID_GROUP = "7111"
+INDEX_UUID_GROUP = "7112"
+DIAG_UUID_GROUP = "7113"
+MOVE_UUID_GROUP = "7114"
+MOVE_DONE_UUID_GROUP = "7115"
+HISTORY_UUID_GROUP = "7116"
+HISTORY_REQUEST_STRUCT = struct.Struct("<ddB")
+HISTORY_ZLIB = 0x01
+FIRST_AXIS_ID = 2
+GROUP_SIZE = 8
+CONNECT_TIMEOUT = 2.0
+MAX_VALUE_LENGTH = 512
+# ATT_MTU until the client reports a larger one
+DEFAULT_MTU = 23
+PUT_TIMEOUT = 60
+# A move is overdue once it took TIMEOUT_FACTOR times its expected duration plus TIMEOUT_MARGIN seconds
+TIMEOUT_FACTOR = 2
+TIMEOUT_MARGIN = 5
+# Read once a move completes rather than taken from the monitors, whose last update may predate its end
+MOVE_DONE_FIELDS = ("RBV", "LVIO")
+# Outcomes passed to the callback of a move
+DONE = 0
+FAILED = 1
+DISCARDED = 2
+STOPPED = 3
+
+
+def make_uuid(id, group):
+    # The first UUID field holds the axis id as 8 hex digits, ids 2-9 keep their original UUIDs
+    if not 0 < id <= 0xFFFFFFFF:
+        raise ValueError(f"Axis id {id} does not fit in a UUID")
+    return f"{id:08x}-{group}-{UUID_SUFFIX}"
+
+
+def read_long(key, options, read, reply_handler, error_handler):
+    """
+    Serves a value that may take several Read Blob requests. It is read and encoded once,
+    at offset 0, by read(reply_handler, error_handler), and the following offsets are sliced
+    from that snapshot, kept per client until the last chunk is served.
+    """
+    session = sessions.get(options)
+    offset = int(options.get("offset", 0))
+    # A Read (Blob) Response holds ATT_MTU - 1 bytes of the value
+    chunk = int(options.get("mtu", DEFAULT_MTU)) - 1
+
+    def reply(value):
+        if offset > len(value):
+            session.drop_snapshot(key)
+            error_handler(InvalidOffsetException(f"Offset {offset} beyond {len(value)} bytes"))
+            return
+
+        if offset + chunk < len(value):
+            session.set_snapshot(key, value)
+        else:
+            session.drop_snapshot(key)
+        reply_handler(bytes(value[offset:]))
+
+    snapshot = session.get_snapshot(key) if offset else None
+    if snapshot is not None:
+        reply(snapshot)
+    else:
+        read(reply, error_handler)
+
+
+def fit_notification(value, name):
+    limit = sessions.get_notify_limit()
+    if limit is not None and len(value) > limit:
+        # BlueZ would cut it anyway, this way it is counted
+        TRUNCATED.inc(name)
+        return value[:limit]
+    return value
+
+
+def encode_position(pv_name, position, fmt=ASCII, digits=DIGITS):
+    # PREC sets the decimals of ASCII positions, int32 keeps the scale its 0x2904 descriptor advertises
+    axis = metadata.get(pv_name)
+    if fmt == ASCII and axis is not None:
+        return encode_number(position, fmt, axis.digits)
+    return encode_number(position, fmt, digits)
+
+
+def encode_notified_position(pv_name, position, fmt=ASCII, digits=DIGITS):
+    try:
+        return encode_position(pv_name, position, fmt, digits)
+    except FailedException:
+        # An int32 position out of range has no value to notify; reads report it as a failure
+        return None
+
+
+def encode_lvio(lvio, fmt=ASCII):
+    return encode_string(str(lvio)) if fmt == ASCII else encode_flag(lvio, fmt)
+
+
+def encode_diagnostics():
+    return encode_string(registry.summarize()[:MAX_VALUE_LENGTH])
+
+
+def get_move_timeout(pv_name, field, value, position=None):
+    """
+    Seconds after which a move is overdue, from the distance to travel and the VELO and ACCL
+    of the axis, or PUT_TIMEOUT while any of them is unknown.
+    """
+    axis = metadata.get(pv_name)
+    try:
+        distance = float(value) if field == "RLV" else float(value) - float(position)
+    except (TypeError, ValueError):
+        return PUT_TIMEOUT
+    duration = None if axis is None else axis.get_move_time(distance)
+    return PUT_TIMEOUT if duration is None else TIMEOUT_FACTOR * duration + TIMEOUT_MARGIN
+
+
+class GroupMove(object):
+    """Collects the outcomes of the moves of several axes and reports once all of them have one."""
+
+    def __init__(self, count, callback):
+        self.remaining = count
+        self.outcome = DONE
+        self.callback = callback
+
+    def start(self, moves):
+        # Each move is an axis characteristic and its target
+        for chrc, target in moves:
+            chrc.commands.move("VAL", target, self.on_axis_done)
+
+    def on_axis_done(self, outcome):
+        # The first axis that did not reach its target decides the outcome of the group
+        if self.outcome == DONE:
+            self.outcome = outcome
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.callback(self.outcome)
+
+
+def get_group_targets(targets, pvs):
+    """
+    The PV and target of every (slot, target) pair of a group move, slots indexing pvs, once
+    every target is checked against the soft limits of its axis.
+    """
+    slots = [slot for slot, _ in targets]
+    if len(set(slots)) != len(slots):
+        raise FailedException("An axis can only be moved once per group move")
+
+    moves = []
+    for slot, target in targets:
+        pv = pvs[slot] if slot < len(pvs) else None
+        if pv is None:
+            raise FailedException(f"No axis in slot {slot}")
+        axis = metadata.get(pv)
+        if axis is None:
+            # Without the soft limits no target can be checked, so nothing moves
+            raise FailedException(f"{pv}: soft limits not known yet")
+        if not math.isfinite(target) or not axis.check_limits(target):
+            raise FailedException(f"{pv}: target {target} is out of the soft limits")
+        moves.append((pv, target))
+    return moves
+
+
+class HistoryWindows(object):
+    """
+    The window of position history each session requested last, read back in chunks, one
+    chunk per read.
+    """
+
+    def __init__(self, pv_name, history):
+        self.pv_name = pv_name
+        self.history = history
+        # Chunks of the last window of each session and the next one to read
+        self.results = {}
+
+    def on_session_closed(self, session):
+        self.results.pop(session.device, None)
+
+    def request(self, session, value):
+        if len(value) != HISTORY_REQUEST_STRUCT.size:
+            raise InvalidValueLengthException(f"History requests are {HISTORY_REQUEST_STRUCT.size} bytes long")
+
+        start, end, flags = HISTORY_REQUEST_STRUCT.unpack(bytes(value))
+        # Times up to 0 are relative to now, so the client clock does not matter
+        now = time.time()
+        start, end = [now + t if t <= 0 else t for t in (start, end)]
+        axis = metadata.get(self.pv_name)
+        payload = encode_samples(self.history.get_window(start, end), DIGITS if axis is None else axis.digits)
+        chunks = split_chunks(payload, MAX_VALUE_LENGTH, bool(flags & HISTORY_ZLIB))
+        self.results[session.device] = (chunks, 0)
+
+    def next_chunk(self, session):
+        chunks, index = self.results.get(session.device, ([], 0))
+        if index >= len(chunks):
+            # Past the last chunk, or no window requested
+            return encode_history_end(len(chunks))
+        self.results[session.device] = (chunks, index + 1)
+        return chunks[index]
+
+
+class PVWatchList(object):
+    """
+    The custom PVs selected by the sessions, subscribed while notifying. Each PV is watched
+    once however many sessions selected it; hold and release bracket that watch.
+    """
+
+    def __init__(self, notifier, send):
+        self.notifier = notifier
+        self.send = send
+        self.notifying = False
+        # Number of sessions that selected each PV, and the units of each one
+        self.watched = {}
+        self.egus = {}
+        self.callbacks = {}
+
+    def hold(self, pv_name):
+        pass
+
+    def release(self, pv_name):
+        pass
+
+    def encode_value(self, pv_name, pv_value):
+        strtemp = f"{'Invalid' if pv_value is None else str(pv_value)} {self.egus.get(pv_name, ' ')}"
+        if len(self.watched) > 1:
+            # Centrals watching different PVs share the notifications, tell them apart by name
+            strtemp = f"{pv_name} {strtemp}"
+        return encode_string(strtemp)
+
+    def set_value_callback(self, pv_name, pv_value):
+        if self.notifying:
+            self.send(self.encode_value(pv_name, pv_value))
+
+    def subscribe(self, pv_name):
+        self.callbacks[pv_name] = partial(self.set_value_callback, pv_name)
+        self.notifier.subscribe(pv_name, self.callbacks[pv_name])
+
+    def unsubscribe(self, pv_name):
+        self.notifier.unsubscribe(pv_name, self.callbacks.pop(pv_name))
+
+    def start(self):
+        self.notifying = True
+        for pv_name in self.watched:
+            self.subscribe(pv_name)
+
+    def stop(self):
+        self.notifying = False
+        for pv_name in list(self.callbacks):
+            self.unsubscribe(pv_name)
+
+    def watch(self, pv_name, pv_egu):
+        self.egus[pv_name] = pv_egu
+        self.watched[pv_name] = self.watched.get(pv_name, 0) + 1
+        if self.watched[pv_name] == 1:
+            self.hold(pv_name)
+            if self.notifying:
+                self.subscribe(pv_name)
+
+    def unwatch(self, pv_name):
+        self.watched[pv_name] -= 1
+        if self.watched[pv_name] == 0:
+            del self.watched[pv_name]
+            del self.egus[pv_name]
+            if self.notifying:
+                self.unsubscribe(pv_name)
+            self.release(pv_name)
+
+    def select(self, session, pv_name, pv_egu):
+        if pv_name:
+            self.watch(pv_name, pv_egu)
+        if session.custom_pv:
+            self.unwatch(session.custom_pv)
+        session.custom_pv = pv_name
+
+    def on_session_closed(self, session):
+        if session.custom_pv:
+            self.unwatch(session.custom_pv)
+            session.custom_pv = None
+
+
+class AxesFrame(object):
+    """
+    RBV, VAL, MOVN and LVIO of the axes of a service, from their monitors. Updates are sent
+    as one frame per main loop cycle; schedule(callback) runs callback once the current
+    cycle is over.
+    """
+
+    FIELDS = ("RBV", "VAL", "MOVN", "LVIO")
+
+    def __init__(self, notifier, send, schedule, pvs):
+        self.notifier = notifier
+        self.send = send
+        self.schedule = schedule
+        self.notifying = False
+        self.pvs = []
+        self.axes = []
+        self.seq = 0
+        self.changed = 0
+        self.flush_scheduled = False
+        self.subscriptions = {}
+        for pv in pvs:
+            self.add_pv(pv)
+
+    def add_pv(self, pv):
+        # Slots freed by removed axes are reused first, so the frame only grows when it must
+        if None in self.pvs:
+            axis = self.pvs.index(None)
+            self.pvs[axis] = pv
+        else:
+            axis = len(self.pvs)
+            self.pvs.append(pv)
+            self.axes.append(None)
+        self.axes[axis] = [None] * len(self.FIELDS)
+        self.subscriptions[axis] = [
+            (f"{pv}.{field}", partial(self.set_field_callback, axis, index)) for index, field in enumerate(self.FIELDS)
+        ]
+        if self.notifying:
+            for pv_name, callback in self.subscriptions[axis]:
+                self.notifier.subscribe(pv_name, callback)
+
+    def remove_pv(self, pv):
+        # The slot is cleared rather than dropped, so the other axes keep their place in the frame
+        axis = self.pvs.index(pv)
+        for pv_name, callback in self.subscriptions.pop(axis):
+            if self.notifying:
+                self.notifier.unsubscribe(pv_name, callback)
+        self.pvs[axis] = None
+        self.axes[axis] = [None] * len(self.FIELDS)
+        self.set_changed(axis)
+
+    def get_pv_names(self):
+        return [f"{pv}.{field}" for pv in self.pvs if pv is not None for field in self.FIELDS]
+
+    def set_changed(self, axis):
+        self.changed |= 1 << axis
+        if not self.flush_scheduled:
+            # Every update dispatched in this main loop cycle goes out in a single frame
+            self.flush_scheduled = True
+            self.schedule(self.flush)
+
+    def set_field_callback(self, axis, index, value):
+        if value is None or self.axes[axis][index] == value:
+            return
+
+        self.axes[axis][index] = value
+        self.set_changed(axis)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.notifying and self.changed:
+            self.seq += 1
+            # Axes that do not fit the smallest client MTU are left out, they can still be read
+            count = get_axes_frame_capacity(sessions.get_notify_limit(), len(self.axes))
+            self.send(encode_axes_frame(self.seq, self.changed & ((1 << count) - 1), self.axes[:count]))
+        self.changed = 0
+        return False
+
+    def encode(self, values=None):
+        """The full frame, from the monitors while notifying, else from values by PV name."""
+        if values is None:
+            return encode_axes_frame(self.seq, 0, self.axes)
+        axes = [[pv and values.get(f"{pv}.{field}") for field in self.FIELDS] for pv in self.pvs]
+        return encode_axes_frame(self.seq, 0, axes)
+
+    def start(self):
+        self.notifying = True
+        for subscriptions in self.subscriptions.values():
+            for pv_name, callback in subscriptions:
+                self.notifier.subscribe(pv_name, callback)
+
+    def stop(self):
+        self.notifying = False
+        for subscriptions in self.subscriptions.values():
+            for pv_name, callback in subscriptions:
+                self.notifier.unsubscribe(pv_name, callback)
+
+
+class AxisTable(object):
+    """Lines of "axis id, service index, PV", all of them or the one axis a session selected."""
+
+    def __init__(self, services):
+        self.entries = {}
+        for shard in services:
+            for id, pv in shard.axes:
+                self.entries[id] = encode_string(f"{id:08x} {shard.index} {pv}\n")
+        self.table = self.encode_table()
+
+    def encode_table(self):
+        return encode_string("".join(entry.decode() for entry in self.entries.values()))
+
+    def add_axis(self, id, shard, pv):
+        self.entries[id] = encode_string(f"{id:08x} {shard} {pv}\n")
+        self.table = self.encode_table()
+
+    def remove_axis(self, id):
+        self.entries.pop(id, None)
+        self.table = self.encode_table()
+
+    def get(self, session):
+        return self.entries.get(session.axis_id, self.table)
+
+    def select(self, session, value):
+        if not value:
+            session.axis_id = None
+        elif len(value) != 4:
+            raise InvalidValueLengthException("Axis ids are 4 bytes long")
+        else:
+            id = int.from_bytes(bytes(value), "little")
+            if id not in self.entries:
+                raise FailedException(f"No axis with id {id:08x}")
+            session.axis_id = id
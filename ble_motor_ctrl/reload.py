@@ -0,0 +1,61 @@
+from gi.repository import Gio
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+DEBOUNCE = 200
+EVENTS = (
+    Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+    Gio.FileMonitorEvent.CREATED,
+    Gio.FileMonitorEvent.MOVED_IN,
+    Gio.FileMonitorEvent.RENAMED,
+)
+
+
+class ConfigWatcher(object):
+    """
+    Calls on_change once a burst of changes to a file has settled for debounce ms. The file
+    is watched through a GIO file monitor, backed by inotify on Linux, so editors that save
+    by renaming a new file over the old one are followed too.
+    """
+
+    def __init__(self, path, on_change, debounce=DEBOUNCE):
+        self.file = Gio.File.new_for_path(path)
+        self.on_change = on_change
+        self.debounce = debounce
+        self.monitor = None
+        self.timer = None
+
+    def start(self):
+        if self.monitor is not None:
+            return
+
+        self.monitor = self.file.monitor_file(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        self.monitor.connect("changed", self._on_changed)
+
+    def stop(self):
+        if self.timer is not None:
+            GObject.source_remove(self.timer)
+            self.timer = None
+        if self.monitor is not None:
+            self.monitor.cancel()
+            self.monitor = None
+
+    def _on_changed(self, monitor, file, other_file, event):
+        if event not in EVENTS:
+            return
+
+        if self.timer is not None:
+            GObject.source_remove(self.timer)
+        self.timer = GObject.timeout_add(self.debounce, self._fire)
+
+    def _fire(self):
+        self.timer = None
+        try:
+            self.on_change()
+        except Exception as e:
+            # A half-written or invalid file leaves the running configuration untouched
+            print(f"Config reload failed: {e}")
+        return False
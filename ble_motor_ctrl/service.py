@@ -21,13 +21,15 @@ SOFTWARE.
 
 import dbus
 import dbus.mainloop.glib
-import dbus.exceptions
 
 try:
     from gi.repository import GObject
 except ImportError:
     import gobject as GObject
 from ble_motor_ctrl.bletools import BleTools
+from ble_motor_ctrl.errors import InvalidArgsException, NotSupportedException
+from ble_motor_ctrl.metrics import NOTIFICATIONS
+from ble_motor_ctrl.protocol import fit_notification
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
@@ -38,18 +40,6 @@ GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
 GATT_DESC_IFACE = "org.bluez.GattDescriptor1"
 
 
-class InvalidArgsException(dbus.exceptions.DBusException):
-    _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
-
-
-class NotSupportedException(dbus.exceptions.DBusException):
-    _dbus_error_name = "org.bluez.Error.NotSupported"
-
-
-class NotPermittedException(dbus.exceptions.DBusException):
-    _dbus_error_name = "org.bluez.Error.NotPermitted"
-
-
 class Application(dbus.service.Object):
     def __init__(self):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -58,6 +48,8 @@ class Application(dbus.service.Object):
         self.path = "/"
         self.services = []
         self.next_index = 0
+        self.objects = None
+        self.registered = False
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_path(self):
@@ -65,37 +57,76 @@ class Application(dbus.service.Object):
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        self.object_added(service)
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        self.object_removed(service)
+        service.application = None
+
+    def update_service(self, service, update):
+        # BlueZ ignores characteristics added to or removed from a service it already holds,
+        # so a registered service is withdrawn while update() changes it and announced anew
+        announce = self.registered and service in self.services
+        if announce:
+            for path, interfaces in reversed(list(service.get_managed_objects().items())):
+                self.InterfacesRemoved(path, dbus.Array(interfaces.keys(), signature="s"))
+            service.application = None
+        update()
+        if announce:
+            service.application = self
+            self.object_added(service)
+
+    def object_added(self, obj):
+        self.objects = None
+        if self.registered:
+            for path, interfaces in obj.get_managed_objects().items():
+                self.InterfacesAdded(path, interfaces)
+
+    def object_removed(self, obj):
+        self.objects = None
+        # Children are reported first, and every removed object is unexported from the bus
+        for path, interfaces in reversed(list(obj.get_managed_objects().items())):
+            if self.registered:
+                self.InterfacesRemoved(path, dbus.Array(interfaces.keys(), signature="s"))
+        obj.unexport()
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
     def GetManagedObjects(self):
-        response = {}
+        if self.objects is None:
+            self.objects = {}
+            for service in self.services:
+                self.objects.update(service.get_managed_objects())
 
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
+        return self.objects
 
-        return response
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oa{sa{sv}}")
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oas")
+    def InterfacesRemoved(self, path, interfaces):
+        pass
 
-    def register_app_callback(self):
+    def register_app_callback(self, callback=None):
+        self.registered = True
         print("GATT application registered")
+        if callback is not None:
+            callback()
 
     def register_app_error_callback(self, error):
         print("Failed to register application: " + str(error))
 
-    def register(self):
-        adapter = BleTools.find_adapter(self.bus)
+    def register(self, adapter=None, callback=None):
+        adapter = adapter or BleTools.find_adapter(self.bus)
 
         service_manager = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, adapter), GATT_MANAGER_IFACE)
 
         service_manager.RegisterApplication(
             self.get_path(),
             {},
-            reply_handler=self.register_app_callback,
+            reply_handler=lambda: self.register_app_callback(callback),
             error_handler=self.register_app_error_callback,
         )
 
@@ -113,26 +144,57 @@ class Service(dbus.service.Object):
     def __init__(self, index, uuid, primary):
         self.bus = BleTools.get_bus()
         self.path = self.PATH_BASE + str(index)
+        self.index = index
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
         self.next_index = 0
+        self.application = None
+        self.properties = None
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_SERVICE_IFACE: {
-                "UUID": self.uuid,
-                "Primary": self.primary,
-                "Characteristics": dbus.Array(self.get_characteristic_paths(), signature="o"),
+        if self.properties is None:
+            self.properties = {
+                GATT_SERVICE_IFACE: {
+                    "UUID": self.uuid,
+                    "Primary": self.primary,
+                    "Characteristics": dbus.Array(self.get_characteristic_paths(), signature="o"),
+                }
             }
-        }
+
+        return self.properties
+
+    def get_managed_objects(self):
+        objects = {self.get_path(): self.get_properties()}
+        for chrc in self.characteristics:
+            objects.update(chrc.get_managed_objects())
+        return objects
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
+    def get_application(self):
+        return self.application
+
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.properties = None
+        if self.application is not None:
+            self.application.object_added(characteristic)
+
+    def remove_characteristic(self, characteristic):
+        self.characteristics.remove(characteristic)
+        self.properties = None
+        if self.application is not None:
+            self.application.object_removed(characteristic)
+        else:
+            characteristic.unexport()
+
+    def unexport(self):
+        for chrc in self.characteristics:
+            chrc.unexport()
+        self.remove_from_connection()
 
     def get_characteristic_paths(self):
         result = []
@@ -174,23 +236,51 @@ class Characteristic(dbus.service.Object):
         self.flags = flags
         self.descriptors = []
         self.next_index = 0
+        self.properties = None
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_CHRC_IFACE: {
-                "Service": self.service.get_path(),
-                "UUID": self.uuid,
-                "Flags": self.flags,
-                "Descriptors": dbus.Array(self.get_descriptor_paths(), signature="o"),
+        if self.properties is None:
+            self.properties = {
+                GATT_CHRC_IFACE: {
+                    "Service": self.service.get_path(),
+                    "UUID": self.uuid,
+                    "Flags": self.flags,
+                    "Descriptors": dbus.Array(self.get_descriptor_paths(), signature="o"),
+                }
             }
-        }
+
+        return self.properties
+
+    def get_managed_objects(self):
+        objects = {self.get_path(): self.get_properties()}
+        for desc in self.descriptors:
+            objects.update(desc.get_managed_objects())
+        return objects
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.properties = None
+        application = self.service.get_application()
+        if application is not None:
+            application.object_added(descriptor)
+
+    def remove_descriptor(self, descriptor):
+        self.descriptors.remove(descriptor)
+        self.properties = None
+        application = self.service.get_application()
+        if application is not None:
+            application.object_removed(descriptor)
+        else:
+            descriptor.unexport()
+
+    def unexport(self):
+        for desc in self.descriptors:
+            desc.unexport()
+        self.remove_from_connection()
 
     def get_descriptor_paths(self):
         result = []
@@ -201,6 +291,11 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
+    def notify_value(self, value):
+        value = dbus.ByteArray(fit_notification(value, type(self).__name__))
+        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+        NOTIFICATIONS.inc(type(self).__name__)
+
     @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
     def GetAll(self, interface):
         if interface != GATT_CHRC_IFACE:
@@ -208,13 +303,22 @@ class Characteristic(dbus.service.Object):
 
         return self.get_properties()[GATT_CHRC_IFACE]
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="ay")
-    def ReadValue(self, options):
+    @dbus.service.method(
+        GATT_CHRC_IFACE,
+        in_signature="a{sv}",
+        out_signature="ay",
+        async_callbacks=("reply_handler", "error_handler"),
+    )
+    def ReadValue(self, options, reply_handler, error_handler):
         print("Default ReadValue called, returning error")
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature="aya{sv}")
-    def WriteValue(self, value, options):
+    @dbus.service.method(
+        GATT_CHRC_IFACE,
+        in_signature="aya{sv}",
+        async_callbacks=("reply_handler", "error_handler"),
+    )
+    def WriteValue(self, value, options, reply_handler, error_handler):
         print("Default WriteValue called, returning error")
         raise NotSupportedException()
 
@@ -243,9 +347,6 @@ class Characteristic(dbus.service.Object):
 
         return idx
 
-    def add_timeout(self, timeout, callback):
-        GObject.timeout_add(timeout, callback)
-
 
 class Descriptor(dbus.service.Object):
     def __init__(self, uuid, flags, characteristic):
@@ -255,16 +356,26 @@ class Descriptor(dbus.service.Object):
         self.flags = flags
         self.chrc = characteristic
         self.bus = characteristic.get_bus()
+        self.properties = None
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_DESC_IFACE: {
-                "Characteristic": self.chrc.get_path(),
-                "UUID": self.uuid,
-                "Flags": self.flags,
+        if self.properties is None:
+            self.properties = {
+                GATT_DESC_IFACE: {
+                    "Characteristic": self.chrc.get_path(),
+                    "UUID": self.uuid,
+                    "Flags": self.flags,
+                }
             }
-        }
+
+        return self.properties
+
+    def get_managed_objects(self):
+        return {self.get_path(): self.get_properties()}
+
+    def unexport(self):
+        self.remove_from_connection()
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -276,12 +387,21 @@ class Descriptor(dbus.service.Object):
 
         return self.get_properties()[GATT_DESC_IFACE]
 
-    @dbus.service.method(GATT_DESC_IFACE, in_signature="a{sv}", out_signature="ay")
-    def ReadValue(self, options):
+    @dbus.service.method(
+        GATT_DESC_IFACE,
+        in_signature="a{sv}",
+        out_signature="ay",
+        async_callbacks=("reply_handler", "error_handler"),
+    )
+    def ReadValue(self, options, reply_handler, error_handler):
         print("Default ReadValue called, returning error")
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_DESC_IFACE, in_signature="aya{sv}")
-    def WriteValue(self, value, options):
+    @dbus.service.method(
+        GATT_DESC_IFACE,
+        in_signature="aya{sv}",
+        async_callbacks=("reply_handler", "error_handler"),
+    )
+    def WriteValue(self, value, options, reply_handler, error_handler):
         print("Default WriteValue called, returning error")
         raise NotSupportedException()
@@ -0,0 +1,98 @@
+import time
+
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+DEVICE_IFACE = "org.bluez.Device1"
+# Longest a long read may take between its Read Blob requests
+SNAPSHOT_TTL = 5.0
+# ATT notification header: opcode and attribute handle
+NOTIFY_HEADER = 3
+
+
+class Session(object):
+    def __init__(self, device):
+        self.device = device
+        self.custom_pv = None
+        self.axis_id = None
+        self.mtu = None
+        self.snapshots = {}
+        self.last_seen = time.monotonic()
+
+    def get_snapshot(self, key):
+        value, expires = self.snapshots.get(key, (None, 0.0))
+        if expires < time.monotonic():
+            self.snapshots.pop(key, None)
+            return None
+        return value
+
+    def set_snapshot(self, key, value, ttl=SNAPSHOT_TTL):
+        self.snapshots[key] = (value, time.monotonic() + ttl)
+
+    def drop_snapshot(self, key):
+        self.snapshots.pop(key, None)
+
+
+class SessionManager(object):
+    """
+    Per-central state, keyed on the device object path BlueZ passes in the ReadValue and
+    WriteValue options. Requests without one share a single anonymous session. A session
+    is closed, and its close listeners called, when its device disconnects.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.close_listeners = []
+        self.bus = None
+
+    def watch(self, bus):
+        if self.bus is not None:
+            return
+
+        self.bus = bus
+        bus.add_signal_receiver(
+            self._on_properties_changed,
+            dbus_interface=DBUS_PROP_IFACE,
+            signal_name="PropertiesChanged",
+            arg0=DEVICE_IFACE,
+            path_keyword="path",
+        )
+
+    def get(self, options):
+        device = options.get("device")
+        key = str(device) if device else None
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = Session(key)
+        session.last_seen = time.monotonic()
+        if "mtu" in options:
+            session.mtu = int(options["mtu"])
+        return session
+
+    def get_notify_limit(self):
+        """
+        Largest notification every known client can receive whole, or None while no client
+        has reported its MTU. Notifications are broadcast, so the smallest MTU wins.
+        """
+        mtus = [session.mtu for session in self.sessions.values() if session.mtu]
+        return min(mtus) - NOTIFY_HEADER if mtus else None
+
+    def add_close_listener(self, callback):
+        self.close_listeners.append(callback)
+
+    def remove_close_listener(self, callback):
+        if callback in self.close_listeners:
+            self.close_listeners.remove(callback)
+
+    def close(self, device):
+        session = self.sessions.pop(str(device), None)
+        if session is None:
+            return
+
+        for callback in self.close_listeners:
+            callback(session)
+
+    def _on_properties_changed(self, interface, changed, invalidated, path=None):
+        if "Connected" in changed and not changed["Connected"]:
+            self.close(path)
+
+
+sessions = SessionManager()
@@ -0,0 +1,32 @@
+import time
+
+# Imported first by main.py, so this is as close to process start as the package gets
+START = time.monotonic()
+
+
+class StartupTimer(object):
+    """Time spent in each startup phase, in the order they ran."""
+
+    def __init__(self, start=START):
+        self.start = start
+        self.last = start
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def get_stats(self):
+        stats = {f"{phase}_ms": round(elapsed * 1000, 1) for phase, elapsed in self.phases.items()}
+        stats["total_ms"] = round((self.last - self.start) * 1000, 1)
+        return stats
+
+    def report(self):
+        elapsed = 0.0
+        for phase, duration in self.phases.items():
+            elapsed += duration
+            print(f"Startup {phase:<10}{duration * 1000:>9.1f} ms{elapsed * 1000:>10.1f} ms")
+
+
+startup = StartupTimer()
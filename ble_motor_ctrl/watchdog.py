@@ -0,0 +1,94 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+from logging.handlers import RotatingFileHandler
+
+from ble_motor_ctrl.metrics import STALLS
+
+THRESHOLD = 1.0
+HEARTBEAT_PERIOD = 100
+LOG_PATH = "watchdog.log"
+MAX_BYTES = 1024 * 1024
+BACKUP_COUNT = 3
+PV_LOCALS = ("pv_name", "pvname")
+
+logger = logging.getLogger("ble_motor_ctrl.watchdog")
+
+
+def find_pv(frame):
+    # Innermost frame that names a PV, either as a local or as an attribute of self
+    while frame is not None:
+        local_vars = frame.f_locals
+        for name in PV_LOCALS:
+            if isinstance(local_vars.get(name), str):
+                return local_vars[name]
+        pv_name = getattr(local_vars.get("self"), "pv_name", None)
+        if isinstance(pv_name, str):
+            return pv_name
+        frame = frame.f_back
+    return None
+
+
+class Watchdog(object):
+    """
+    Detects main loop stalls. The lag probe of each runtime bumps a heartbeat from its main loop;
+    when a thread, checking it every heartbeat_period ms, sees it older than threshold seconds,
+    it logs the main thread stack and the PV it was handling, then logs the stall duration once
+    the loop recovers.
+    """
+
+    def __init__(self, threshold=THRESHOLD, heartbeat_period=HEARTBEAT_PERIOD):
+        self.threshold = threshold
+        self.heartbeat_period = heartbeat_period
+        self.last_beat = None
+        self.stalled = False
+        self.since = None
+        self.main_thread = threading.main_thread().ident
+
+    def start(self, log_path=LOG_PATH, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        if not self.threshold:
+            return
+
+        handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+        # The first beat only comes once the loop runs, so startup is never taken for a stall
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def beat(self):
+        self.last_beat = time.monotonic()
+        return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self.heartbeat_period / 1000)
+            if self.last_beat is None:
+                continue
+
+            lag = time.monotonic() - self.last_beat
+            if lag > self.threshold and not self.stalled:
+                self.stalled = True
+                self.since = self.last_beat
+                STALLS.inc()
+                self._report(lag)
+            elif self.stalled and self.last_beat > self.since:
+                self.stalled = False
+                logger.info(f"Main loop recovered after {self.last_beat - self.since:.3f} s")
+
+    def _report(self, lag):
+        frame = sys._current_frames().get(self.main_thread)
+        if frame is None:
+            return
+
+        stack = "".join(traceback.format_stack(frame))
+        logger.warning(f"Main loop stalled for {lag:.3f} s, PV: {find_pv(frame)}\n{stack}")
+
+
+def start(threshold=THRESHOLD, heartbeat_period=HEARTBEAT_PERIOD, **kwargs):
+    watchdog = Watchdog(threshold, heartbeat_period)
+    watchdog.start(**kwargs)
+    return watchdog
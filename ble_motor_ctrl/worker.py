@@ -0,0 +1,96 @@
+import queue
+import threading
+
+from ble_motor_ctrl.cache import pv_cache, FETCH_TIMEOUT
+from ble_motor_ctrl.errors import FailedException, GattException
+
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+WORKERS = 4
+QUEUE_SIZE = 64
+
+
+class CAWorkerPool(object):
+    """
+    Runs blocking CA calls on a bounded pool of threads and replies from the main loop.
+    Every key is bound to one worker, so jobs sharing a key are never reordered.
+    """
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.lanes = []
+
+    def configure(self, workers=None, queue_size=None):
+        if self.lanes:
+            raise RuntimeError("CA worker pool already started")
+        if workers is not None:
+            self.workers = workers
+        if queue_size is not None:
+            self.queue_size = queue_size
+
+    def start(self):
+        for _ in range(self.workers):
+            lane = queue.Queue(maxsize=self.queue_size)
+            threading.Thread(target=self._run, args=(lane,), daemon=True).start()
+            self.lanes.append(lane)
+
+    def submit(self, key, func, reply_handler, error_handler):
+        if not self.lanes:
+            self.start()
+
+        lane = self.lanes[hash(key) % len(self.lanes)]
+        try:
+            lane.put_nowait((key, func, reply_handler, error_handler))
+        except queue.Full:
+            error_handler(FailedException(f"Too many pending requests for {key}"))
+
+    def get_depth(self):
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def _run(self, lane):
+        while True:
+            key, func, reply_handler, error_handler = lane.get()
+            try:
+                result = func()
+            except GattException as e:
+                print(f"{key}: {e}")
+                GObject.idle_add(self._call, error_handler, e)
+            except Exception as e:
+                print(f"{key}: {e}")
+                GObject.idle_add(self._call, error_handler, FailedException(str(e)))
+            else:
+                if result is None:
+                    GObject.idle_add(self._call, reply_handler)
+                else:
+                    GObject.idle_add(self._call, reply_handler, result)
+
+    @staticmethod
+    def _call(handler, *args):
+        handler(*args)
+        return False
+
+
+workers = CAWorkerPool()
+
+
+def get_axis(pv_name):
+    return pv_name.split(".")[0]
+
+
+def read_pv(pv_name, encode, reply_handler, error_handler, timeout=FETCH_TIMEOUT):
+    hit, value = pv_cache.lookup(pv_name)
+    if hit:
+        reply_handler(encode(value))
+        return
+
+    def fetch():
+        value = pv_cache.fetch(pv_name, timeout)
+        if value is None:
+            raise FailedException(f"Timed out reading {pv_name}")
+        return encode(value)
+
+    workers.submit(get_axis(pv_name), fetch, reply_handler, error_handler)
@@ -1,14 +1,99 @@
-from ble_motor_ctrl import application
+from ble_motor_ctrl.startup import startup
+from ble_motor_ctrl import metrics, watchdog
+from ble_motor_ctrl.backend import backends
+from ble_motor_ctrl.cache import pv_cache
+from ble_motor_ctrl.history import histories
+from ble_motor_ctrl.metadata import metadata
+from ble_motor_ctrl.protocol import CONNECT_TIMEOUT, GROUP_SIZE
 import json
-from epics import caget
 
-with open("config/config.json", "r") as config_file:
-    config = json.load(config_file)
+CONFIG_PATH = "config/config.json"
+BACKEND_KEYS = ("backend", "group", "group_fields")
+backend_settings = {}
 
-pvs = []
 
-for pv in config.get("pvs"):
-    if caget(pv, timeout=1) is not None:
-        pvs.append(pv)
+def load_config(path=CONFIG_PATH):
+    with open(path, "r") as config_file:
+        return json.load(config_file)
 
-application.register(pvs, config.get("name"))
+
+def get_policies(config):
+    policies = {}
+    for entry in config.get("pvs"):
+        axis = {"name": entry} if isinstance(entry, str) else dict(entry)
+        pv = axis.pop("name")
+        set_backend(pv, {key: axis.pop(key) for key in BACKEND_KEYS if key in axis})
+        policies[pv] = {**config.get("policy", {}), **axis}
+    return policies
+
+
+def set_backend(pv, settings):
+    # Reconfiguring an unchanged axis would replace the group monitor its channels are attached to
+    if settings == backend_settings.get(pv, {}):
+        return
+    if settings:
+        backend = dict(settings)
+        backends.set_backend(pv, backend.pop("backend", backends.default), **backend)
+    else:
+        backends.unset_backend(pv)
+    backend_settings[pv] = settings
+
+
+def reload_axes():
+    policies = get_policies(load_config())
+    return list(policies), policies
+
+
+startup.mark("imports")
+
+config = load_config()
+
+pv_cache.configure(**config.get("cache", {}))
+metadata.configure(**config.get("metadata", {}))
+histories.configure(**config.get("history", {}))
+backends.configure(default=config.get("backend"))
+metrics.serve(**config.get("metrics", {}))
+dog = watchdog.start(**config.get("watchdog", {}))
+
+policies = get_policies(config)
+
+lazy_axes = config.get("lazy_axes", False)
+connect_timeout = config.get("connect_timeout", CONNECT_TIMEOUT)
+group_size = config.get("group_size", GROUP_SIZE)
+startup.mark("config")
+
+if config.get("runtime", "glib") == "asyncio":
+    from ble_motor_ctrl import aio
+
+    aio.run(
+        list(policies),
+        config.get("name"),
+        config.get("formats"),
+        policies,
+        group_size,
+        None if lazy_axes else connect_timeout,
+        heartbeat=dog.beat,
+    )
+else:
+    from ble_motor_ctrl import application
+    from ble_motor_ctrl.monitor import pollers
+    from ble_motor_ctrl.pool import pv_pool
+    from ble_motor_ctrl.worker import workers
+
+    pv_pool.configure(**config.get("pool", {}))
+    workers.configure(**config.get("workers", {}))
+    notify = config.get("notify", {})
+    pollers.configure(period=notify.get("period"))
+    application.register(
+        list(policies),
+        config.get("name"),
+        notify.get("mode", "monitor"),
+        config.get("formats"),
+        policies,
+        group_size,
+        connect_timeout,
+        lazy_axes,
+        CONFIG_PATH if config.get("reload", True) else None,
+        reload_axes,
+        dog.beat,
+    )